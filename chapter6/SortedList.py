@@ -1,74 +1,331 @@
+import bisect
+import itertools
+
+# the values are kept in sorted sublists ("chunks") of about this many, so
+# that an insert or delete only shifts the items of one chunk
+CHUNK_SIZE = 1000
+
+
+# the default key; it is shared so that two lists with the default key have
+# equal keys, which lets the copy constructor reuse the order and the keys
+def _identity(value):
+    return value
+
+
 class SortedList:
+    # self.__lists holds the chunks in order and self.__keys the same shape of
+    # lists of their keys, so self.__keys[i][j] is always
+    # self.__key(self.__lists[i][j]); each key is computed once, when its value
+    # is added, and lookups bisect the keys with the bisect module instead of
+    # calling the key function at every probe. self.__maxes[i] is the largest
+    # key of chunk i, for finding the chunk to look in, and self.__offsets the
+    # position of each chunk's first value, for positional access; it is
+    # rebuilt only when needed after the chunks change
     def __init__(self, sequence=None, key=None):
-        _identity = lambda x: x
         self.__key = key or _identity  # wonderfull
         assert hasattr(self.__key, "__call__")  # the function is callable
+        self.__offsets = None
         if sequence is None:
-            self.__list = []
+            self.__set([], [])
         elif (isinstance(sequence, SortedList) and sequence.key == self.__key):
-            self.__list = self.__list[:]
+            # already in order and with the keys computed
+            self.__lists = [values[:] for values in sequence.__lists]
+            self.__keys = [keys[:] for keys in sequence.__keys]
+            self.__maxes = sequence.__maxes[:]
+            self.__len = sequence.__len
+            self.__offsets = sequence.__offsets
         else:
-            self.__list = sorted(list(sequence), key=self.__key)
+            values = list(sequence)
+            keys = [self.__key(value) for value in values]
+            # sort the positions by key so that every key is computed only once
+            order = sorted(range(len(values)), key=keys.__getitem__)
+            self.__set([values[i] for i in order], [keys[i] for i in order])
+
+    def __set(self, values, keys):
+        # replace the contents with the given sorted values and their keys
+        self.__lists = [values[i:i + CHUNK_SIZE] for i in range(0, len(values), CHUNK_SIZE)]
+        self.__keys = [keys[i:i + CHUNK_SIZE] for i in range(0, len(keys), CHUNK_SIZE)]
+        self.__maxes = [chunk[-1] for chunk in self.__keys]
+        self.__len = len(values)
+        self.__offsets = None
 
     @property
     def key(self):
         return self.__key
 
     def add(self, value):
-        index = self.__bisect_left(value)
-        if index == len(self.__list):
-            self.__list.append(value)
+        self.__insert(value, self.__key(value))
+
+    def __insert(self, value, key):
+        if not self.__maxes:
+            self.__lists.append([value])
+            self.__keys.append([key])
+            self.__maxes.append(key)
+        else:
+            chunk = bisect.bisect_left(self.__maxes, key)
+            if chunk == len(self.__maxes):  # larger than everything: it goes at the end
+                chunk -= 1
+                self.__lists[chunk].append(value)
+                self.__keys[chunk].append(key)
+                self.__maxes[chunk] = key
+            else:
+                index = bisect.bisect_left(self.__keys[chunk], key)
+                self.__lists[chunk].insert(index, value)
+                self.__keys[chunk].insert(index, key)
+            if len(self.__lists[chunk]) > 2 * CHUNK_SIZE:
+                self.__split(chunk)
+        self.__len += 1
+        self.__offsets = None
+
+    def update(self, iterable):
+        # add many values at once: the new ones are sorted by themselves and
+        # then merged in, O(n + k log k) for k new values rather than O(k n).
+        # Like add(), new values go before existing ones with equal keys,
+        # and they keep their own order among themselves
+        values = list(iterable)
+        keys = [self.__key(value) for value in values]
+        if len(values) * 4 < self.__len:  # too few to be worth rebuilding for
+            self.__insert_all(values, keys)
+            return
+        order = sorted(range(len(values)), key=keys.__getitem__)
+        self.__merge([values[i] for i in order], [keys[i] for i in order])
+
+    def merge(self, other):
+        # like update(), but a SortedList with the same key is already sorted
+        # and has its keys computed, so neither needs doing again
+        if not (isinstance(other, SortedList) and other.key == self.__key):
+            self.update(other)
+            return
+        values = list(itertools.chain.from_iterable(other.__lists))
+        keys = list(itertools.chain.from_iterable(other.__keys))
+        if len(values) * 4 < self.__len:
+            self.__insert_all(values, keys)
+        else:
+            self.__merge(values, keys)
+
+    def __insert_all(self, values, keys):
+        # each insert goes before the equal keys already there, so going
+        # backwards keeps equal new values in their given order
+        for value, key in zip(reversed(values), reversed(keys)):
+            self.__insert(value, key)
+
+    def __merge(self, values, keys):
+        # values are sorted and keys are their keys; Python's sort finds the
+        # two sorted runs and merges them in a single linear pass, and as it
+        # is stable the new values stay ahead of existing ones with equal keys
+        values = values + list(itertools.chain.from_iterable(self.__lists))
+        keys = keys + list(itertools.chain.from_iterable(self.__keys))
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        self.__set([values[i] for i in order], [keys[i] for i in order])
+
+    def __split(self, chunk):
+        # halve a chunk that has grown too big
+        self.__lists.insert(chunk + 1, self.__lists[chunk][CHUNK_SIZE:])
+        del self.__lists[chunk][CHUNK_SIZE:]
+        self.__keys.insert(chunk + 1, self.__keys[chunk][CHUNK_SIZE:])
+        del self.__keys[chunk][CHUNK_SIZE:]
+        self.__maxes.insert(chunk, self.__keys[chunk][-1])
+
+    def __delete(self, chunk, index):
+        # remove one value; a chunk left empty is dropped and one left small
+        # is joined to its neighbour so that there are never many tiny chunks
+        del self.__lists[chunk][index]
+        del self.__keys[chunk][index]
+        self.__len -= 1
+        self.__offsets = None
+        if not self.__keys[chunk]:
+            del self.__lists[chunk]
+            del self.__keys[chunk]
+            del self.__maxes[chunk]
+        elif len(self.__keys[chunk]) < CHUNK_SIZE // 2 and len(self.__keys) > 1:
+            if chunk == len(self.__keys) - 1:
+                chunk -= 1
+            self.__lists[chunk].extend(self.__lists.pop(chunk + 1))
+            self.__keys[chunk].extend(self.__keys.pop(chunk + 1))
+            del self.__maxes[chunk]
+            self.__maxes[chunk] = self.__keys[chunk][-1]
+            if len(self.__lists[chunk]) > 2 * CHUNK_SIZE:
+                self.__split(chunk)
         else:
-            self.__list.insert(index, value)
+            self.__maxes[chunk] = self.__keys[chunk][-1]
 
     def __bisect_left(self, value):
+        # the (chunk, index) of the first value whose key isn't less than
+        # value's, or None if there isn't one
         key = self.__key(value)
-        left, right = 0, len(self.__list)
-        while left < right:
-            middle = (left + right) // 2  # faster than one by one
-            if self.__key(self.__list[middle]) < key:
-                left = middle + 1
-            else:
-                right = middle
-        return left
+        chunk = bisect.bisect_left(self.__maxes, key)
+        if chunk == len(self.__maxes):
+            return None
+        return chunk, bisect.bisect_left(self.__keys[chunk], key)
+
+    def __next(self, chunk, index):
+        # the (chunk, index) of the value after the given one, or None
+        index += 1
+        if index == len(self.__lists[chunk]):
+            chunk += 1
+            index = 0
+            if chunk == len(self.__lists):
+                return None
+        return chunk, index
+
+    def __position(self, chunk, index):
+        return self.__get_offsets()[chunk] + index
+
+    def __get_offsets(self):
+        if self.__offsets is None:
+            self.__offsets = list(itertools.accumulate(map(len, self.__lists), initial=0))
+        return self.__offsets
+
+    def __locate(self, index):
+        # the (chunk, index) of the value at position index, which may be negative
+        if index < 0:
+            index += self.__len
+        if not 0 <= index < self.__len:
+            raise IndexError("{0} index out of range".format(self.__class__.__name__))
+        if index < len(self.__lists[0]):  # the common cases don't need the offsets
+            return 0, index
+        last = len(self.__lists) - 1
+        if index >= self.__len - len(self.__lists[last]):
+            return last, index - (self.__len - len(self.__lists[last]))
+        offsets = self.__get_offsets()
+        chunk = bisect.bisect_right(offsets, index) - 1
+        return chunk, index - offsets[chunk]
+
+    def bisect_key_left(self, key):
+        # the position of the first value whose key isn't less than key
+        chunk = bisect.bisect_left(self.__maxes, key)
+        if chunk == len(self.__maxes):
+            return self.__len
+        return self.__position(chunk, bisect.bisect_left(self.__keys[chunk], key))
+
+    def bisect_key_right(self, key):
+        # the position just after the last value whose key isn't greater than key
+        chunk = bisect.bisect_right(self.__maxes, key)
+        if chunk == len(self.__maxes):
+            return self.__len
+        return self.__position(chunk, bisect.bisect_right(self.__keys[chunk], key))
+
+    def irange(self, minimum=None, maximum=None, inclusive=(True, True), reverse=False):
+        # iterate over the values whose keys are between minimum and maximum
+        # (None means unbounded), e.g. irange(lo, hi, (True, False)) for keys
+        # in [lo, hi); nothing is copied, so the list mustn't change meanwhile
+        if minimum is None:
+            start = 0
+        elif inclusive[0]:
+            start = self.bisect_key_left(minimum)
+        else:
+            start = self.bisect_key_right(minimum)
+        if maximum is None:
+            stop = self.__len
+        elif inclusive[1]:
+            stop = self.bisect_key_right(maximum)
+        else:
+            stop = self.bisect_key_left(maximum)
+        return self.__islice(start, stop, reverse)
+
+    def islice(self, start=None, stop=None, reverse=False):
+        # iterate over self[start:stop], or over it backwards, without copying it
+        start, stop, step = slice(start, stop).indices(self.__len)
+        return self.__islice(start, stop, reverse)
+
+    def __islice(self, start, stop, reverse):
+        if start >= stop:
+            return iter(())
+        first, first_index = self.__locate(start)
+        last, last_index = self.__locate(stop - 1)
+        if reverse:
+            return self.__iter_backwards(first, first_index, last, last_index)
+        return self.__iter_forwards(first, first_index, last, last_index)
+
+    def __iter_forwards(self, first, first_index, last, last_index):
+        if first == last:
+            yield from itertools.islice(self.__lists[first], first_index, last_index + 1)
+            return
+        yield from itertools.islice(self.__lists[first], first_index, None)
+        for chunk in range(first + 1, last):
+            yield from self.__lists[chunk]
+        yield from itertools.islice(self.__lists[last], last_index + 1)
+
+    def __iter_backwards(self, first, first_index, last, last_index):
+        # reversed() is a view too; islice() skips the values after last_index
+        if first == last:
+            values = self.__lists[first]
+            yield from itertools.islice(reversed(values), len(values) - 1 - last_index,
+                                        len(values) - first_index)
+            return
+        values = self.__lists[last]
+        yield from itertools.islice(reversed(values), len(values) - 1 - last_index, None)
+        for chunk in range(last - 1, first, -1):
+            yield from reversed(self.__lists[chunk])
+        values = self.__lists[first]
+        yield from itertools.islice(reversed(values), len(values) - first_index)
 
     def remove(self, value):
-        index = self.__bisect_left(value)
-        if index < len(self.__list) and self.__list[index] == value:
-            del self.__list[index]
+        location = self.__bisect_left(value)
+        if location is not None and self.__lists[location[0]][location[1]] == value:
+            self.__delete(*location)
         else:
             # there is no the value in the list
             raise ValueError("{0}.remove(x): x not in list".format(self.__class__.__name__))
 
     def remove_every(self, value):
         count = 0
-        index = self.__bisect_left(value)
-        while (index < len(self.__list) and self.__list[index] == value):
-            del self.__list[index]
+        location = self.__bisect_left(value)
+        while location is not None and self.__lists[location[0]][location[1]] == value:
+            position = self.__position(*location)
+            self.__delete(*location)
             count += 1
+            # the next value has moved into the deleted one's position
+            location = self.__locate(position) if position < self.__len else None
         return count
 
     def count(self, value):
         count = 0
-        index = self.__bisect_left(value)
-        while (index < len(self.__list) and self.__list[index] == value):
+        location = self.__bisect_left(value)
+        while location is not None and self.__lists[location[0]][location[1]] == value:
             count += 1
-            index += 1  ##
+            location = self.__next(*location)
         return count
 
     def index(self, value):
-        index = self.__bisect_left(value)
-        if index < len(self.__list) and self.__list[index] == value:
-            return index
+        location = self.__bisect_left(value)
+        if location is not None and self.__lists[location[0]][location[1]] == value:
+            return self.__position(*location)
         else:
             raise ValueError("{0}.index(x): x not in list".format(self.__class__.__name__))
 
     def __delitem__(self, index):
-        del self.__list[index]  # we don't test for an out-of-range index since if one is given
-        # the self.__list[index] call will raise an IndexError exception, which is the behavior we want
+        if isinstance(index, slice):
+            positions = range(*index.indices(self.__len))
+            if len(positions) > self.__len // 8:
+                # cheaper to rebuild than to delete so many one at a time
+                values = list(itertools.chain.from_iterable(self.__lists))
+                keys = list(itertools.chain.from_iterable(self.__keys))
+                del values[index]
+                del keys[index]
+                self.__set(values, keys)
+            else:
+                for position in sorted(positions, reverse=True):
+                    self.__delete(*self.__locate(position))
+        else:
+            self.__delete(*self.__locate(index))  # raises IndexError for an out-of-range index
 
     def __getitem__(self, index):
-        return self.__list[index]
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.__len)
+            if step == 1 and start < stop:
+                first, first_index = self.__locate(start)
+                last, last_index = self.__locate(stop - 1)
+                if first == last:
+                    return self.__lists[first][first_index:last_index + 1]
+                values = self.__lists[first][first_index:]
+                for chunk in range(first + 1, last):
+                    values.extend(self.__lists[chunk])
+                values.extend(self.__lists[last][:last_index + 1])
+                return values
+            return [self.__lists[chunk][i] for chunk, i in map(self.__locate, range(start, stop, step))]
+        chunk, index = self.__locate(index)
+        return self.__lists[chunk][index]
 
     def __setitem__(self, index, value):
         raise TypeError("use add() to insert a value and rely on the list to put it in the right place")
@@ -76,31 +333,30 @@ class SortedList:
     # if a sequence is required it is this method that is used.
     # So to convert a SortedList, L, to a plain list we can call list(L), and behind the scenes
     # PYthon will call SortedList.__iter__(L) to provide the sequence that the list() function requires.
-    def iter(self):
-        return iter(self.__list)
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.__lists)
 
     def __reversed__(self):
-        return reversed(self.__list)
+        return itertools.chain.from_iterable(map(reversed, reversed(self.__lists)))
 
     def __contains__(self, value):  # in operator
-        index = self.__bisect_left(value)
-        return (index < len(self.__list) and self.__list[index] == value)
-        # if index < len(self.__list) and self.__list[index]==value:
-        #    return True
-        # else:
-        #    return False
+        location = self.__bisect_left(value)
+        return (location is not None and self.__lists[location[0]][location[1]] == value)
 
     def clear(self):
-        self.__list = []
+        self.__set([], [])
 
     def pop(self, index=-1):
-        return self.__list.pop(index)
+        chunk, index = self.__locate(index)
+        value = self.__lists[chunk][index]
+        self.__delete(chunk, index)
+        return value
 
     def __len__(self):
-        return len(self.__list)
+        return self.__len
 
     def __str__(self):
-        return str(self.__list)
+        return str(list(itertools.chain.from_iterable(self.__lists)))
 
     def insert(self, index, value):
         raise AttributeError("use add() to insert a value and rely on the list to put it in the right place")
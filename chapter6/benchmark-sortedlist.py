@@ -0,0 +1,70 @@
+import optparse
+import random
+import time
+
+import SortedList
+
+
+class GetItemIteration:
+    # iterates over a SortedList the way Python does when a class has no
+    # __iter__(), by calling __getitem__() with 0, 1, 2, ... until IndexError
+    def __init__(self, sorted_list):
+        self.sorted_list = sorted_list
+
+    def __getitem__(self, index):
+        return self.sorted_list[index]
+
+
+def best_time(function, *args, repeat=3):
+    """the shortest of repeat timings of function(*args), in seconds"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        seconds = time.perf_counter() - start
+        if best is None or seconds < best:
+            best = seconds
+    return best
+
+
+def benchmark(count, repeat, seed=0):
+    """
+    time iterating over and copying a SortedList of count random numbers,
+    with the default key and with a key function (iterating over a
+    SortedDict iterates over its SortedList of keys, so it is covered too;
+    SortedDict.py runs its examples when imported, so it isn't used here)
+
+    :return: a list of (case, seconds) pairs; each "old" case does what
+             the code did before SortedList had __iter__() and a copy
+             constructor that doesn't sort again
+    """
+    rand = random.Random(seed)
+    values = [rand.random() for _ in range(count)]
+    results = []
+    for name, key in (("default key", None), ("key=abs", abs)):
+        sorted_list = SortedList.SortedList(values, key)
+        assert list(sorted_list) == list(GetItemIteration(sorted_list))
+        assert list(sorted_list.copy()) == list(sorted_list)
+        results.append(("iter, " + name, best_time(list, sorted_list, repeat=repeat)))
+        results.append(("iter via __getitem__ (old), " + name,
+                        best_time(list, GetItemIteration(sorted_list), repeat=repeat)))
+        results.append(("copy(), " + name, best_time(sorted_list.copy, repeat=repeat)))
+        results.append(("copy by sorting again (old), " + name,
+                        best_time(lambda: SortedList.SortedList(list(sorted_list), key), repeat=repeat)))
+    return results
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("-n", "--count", dest="count", type="int",
+                      help="the number of values [default: %default]")
+    parser.add_option("-r", "--repeat", dest="repeat", type="int",
+                      help="time each operation this many times and keep the best [default: %default]")
+    parser.set_defaults(count=100000, repeat=3)
+    opts, args = parser.parse_args()
+    for case, seconds in benchmark(opts.count, opts.repeat):
+        print("{0:<40} {1:9.4f}".format(case, seconds))
+
+
+if __name__ == "__main__":
+    main()
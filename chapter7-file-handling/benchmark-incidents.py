@@ -0,0 +1,219 @@
+import concurrent.futures
+import datetime
+import importlib.util
+import json
+import optparse
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+
+def load_convert_incidents():
+    # convert-incidents.py can't be imported in the usual way because of the
+    # hyphen in its name
+    filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), "convert-incidents.py")
+    spec = importlib.util.spec_from_file_location("convert_incidents", filename)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module  # so that pickle can find its classes
+    spec.loader.exec_module(module)
+    return module
+
+
+convert_incidents = load_convert_incidents()
+
+AIRPORTS = ("LHR", "LGW", "JFK", "SFO", "ORD", "CDG", "FRA", "AMS", "MAD", "ZRH")
+AIRCRAFT_TYPES = ("B737", "B747", "B777", "A320", "A330", "A380", "E190", "CRJ9")
+WORDS = ("the", "aircraft", "pilot", "reported", "bird", "strike", "on", "final", "approach",
+         "runway", "tower", "cleared", "engine", "vibration", "returned", "to", "stand", "after",
+         "turbulence", "near", "miss", "with", "light", "climbing", "through", "flight", "level")
+
+
+def make_incidents(count, seed=0):
+    """
+    create a synthetic IncidentCollection
+
+    :param count: the number of incidents
+    :param seed: the same seed always gives the same incidents
+    :return: an IncidentCollection
+    """
+    rand = random.Random(seed)
+    first = datetime.date(1990, 1, 1).toordinal()
+    incidents = convert_incidents.IncidentCollection()
+    for i in range(count):
+        incident = convert_incidents.Incident(
+            "{0:08d}{1:04d}".format(i, rand.randrange(10000)),
+            datetime.date.fromordinal(first + rand.randrange(10000)),
+            rand.choice(AIRPORTS),
+            "N{0:05d}".format(rand.randrange(2000)),
+            rand.choice(AIRCRAFT_TYPES),
+            round(rand.uniform(0, 100), 1),
+            rand.randrange(50, 25000),
+            rand.random() < 0.05,
+            " ".join(rand.choice(WORDS) for _ in range(rand.randrange(10, 120))))
+        incidents[incident.report_id] = incident
+    return incidents
+
+
+def best_time(function, *args, repeat=3):
+    """the shortest of repeat timings of function(*args), in seconds"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        seconds = time.perf_counter() - start
+        if best is None or seconds < best:
+            best = seconds
+    return best
+
+
+# (format name, exporter, exporter keyword arguments, importer) for every
+# import/export pair that is measured
+CASES = (
+    ("pickle", "export_pickle", {}, "import_pickle"),
+    ("pickle.gz", "export_pickle", {"compress": True}, "import_pickle"),
+    ("binary", "export_binary", {}, "import_binary"),
+    ("binary", "export_binary", {}, "import_binary_mmap"),
+    ("binary.gz", "export_binary", {"compress": True}, "import_binary"),
+    ("binary-zlib-blocks", "export_binary", {"codec": "zlib"}, "import_binary"),
+    ("binary-lzma-blocks", "export_binary", {"codec": "lzma"}, "import_binary"),
+    ("binary-strings", "export_binary", {"string_table": True}, "import_binary"),
+    ("binary-strings.gz", "export_binary", {"string_table": True, "compress": True}, "import_binary"),
+    ("text", "export_text", {}, "import_text_manual"),
+    ("text", "export_text", {}, "import_text_regex"),
+    ("text", "export_text", {}, "import_text_stream"),
+    ("xml", "export_xml_etree", {}, "import_xml_iterparse"),
+    ("xml", "export_xml_stream", {}, "import_xml_iterparse"),
+    ("log", "export_log", {}, "import_log"),
+)
+
+
+def peak_rss():
+    """this process's peak resident set size in KB, or None if it can't be found"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak  # macOS gives bytes
+
+
+def measure_write(corpus, filename, exporter, kwargs, repeat):
+    incidents = convert_incidents.IncidentCollection()
+    assert incidents.import_binary(corpus)
+    list(incidents)  # so that the one-off sort isn't part of the timing
+    before = peak_rss()
+    seconds = best_time(lambda: getattr(incidents, exporter)(filename, **kwargs), repeat=repeat)
+    after = peak_rss()
+    return seconds, None if before is None else after - before
+
+
+def measure_read(filename, importer, count, repeat):
+    before = peak_rss()
+    incidents = convert_incidents.IncidentCollection()
+    seconds = best_time(getattr(incidents, importer), filename, repeat=repeat)
+    after = peak_rss()
+    assert len(incidents) == count, "{0} read {1} incidents".format(importer, len(incidents))
+    return seconds, None if before is None else after - before
+
+
+def isolated(function, *args):
+    # each measurement runs in a process of its own so that its peak RSS
+    # isn't hidden by an earlier one's
+    with concurrent.futures.ProcessPoolExecutor(1) as executor:
+        return executor.submit(function, *args).result()
+
+
+def check_threaded_lazy_export(corpus, directory, writers=3):
+    """
+    export a lazily imported corpus to several text files at once with
+    fan_out()'s writer threads, which share one NarrativeSource, and check
+    that every file got the right narratives
+
+    :raises: AssertionError if any narrative was mixed up
+    """
+    expected = convert_incidents.IncidentCollection()
+    assert expected.import_binary(corpus)
+    incidents = convert_incidents.IncidentCollection()
+    assert incidents.import_binary(corpus, lazy_narratives=True)
+    targets = [(os.path.join(directory, "threaded{0}.ait".format(number)), "text") for number in range(writers)]
+    assert incidents.export_many(targets, threaded=True)
+    for filename, format in targets:
+        count = 0
+        for count, incident in enumerate(convert_incidents.iter_text(filename), start=1):
+            # the text format rewraps narratives, so only the words are compared
+            assert incident.narrative.split() == expected[incident.report_id].narrative.split(), \
+                "{0}: wrong narrative for {1}".format(filename, incident.report_id)
+        assert count == len(expected), "{0} has {1} incidents".format(filename, count)
+        os.remove(filename)
+
+
+def benchmark(count, repeat, directory, cases=CASES):
+    """
+    write and read a synthetic corpus of count incidents with every case
+
+    :return: a list of dicts, one per case, with the write and read times in
+             seconds, the file size in bytes and the increase in peak RSS in
+             KB while writing and while reading
+    """
+    corpus = os.path.join(directory, "corpus.aib")
+    make_incidents(count).export_binary(corpus)
+    check_threaded_lazy_export(corpus, directory)
+    results = []
+    for format, exporter, kwargs, importer in cases:
+        filename = os.path.join(directory, "incidents." + format)
+        write_seconds, write_rss = isolated(measure_write, corpus, filename, exporter, kwargs, repeat)
+        read_seconds, read_rss = isolated(measure_read, filename, importer, count, repeat)
+        results.append({"format": format, "exporter": exporter, "importer": importer,
+                        "write_seconds": write_seconds, "read_seconds": read_seconds,
+                        "size": os.path.getsize(filename),
+                        "write_peak_rss_kb": write_rss, "read_peak_rss_kb": read_rss})
+        os.remove(filename)
+    return results
+
+
+def print_results(results):
+    print("{0:<20} {1:<18} {2:<21} {3:>9} {4:>9} {5:>12} {6:>10} {7:>10}".format(
+        "format", "exporter", "importer", "write s", "read s", "bytes", "write +KB", "read +KB"))
+    for result in results:
+        print("{format:<20} {exporter:<18} {importer:<21} {write_seconds:9.3f} {read_seconds:9.3f} "
+              "{size:12,} {write:>10} {read:>10}".format(
+            write=str(result["write_peak_rss_kb"]), read=str(result["read_peak_rss_kb"]), **result))
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("-n", "--count", dest="count", type="int",
+                      help="the number of synthetic incidents [default: %default]")
+    parser.add_option("-r", "--repeat", dest="repeat", type="int",
+                      help="time each operation this many times and keep the best [default: %default]")
+    parser.add_option("-o", "--output", dest="output",
+                      help="also save the results to this JSON file")
+    parser.add_option("-f", "--format", dest="formats", action="append",
+                      help="only benchmark this format (may be given more than once)")
+    parser.set_defaults(count=10000, repeat=3)
+    opts, args = parser.parse_args()
+    cases = [case for case in CASES if opts.formats is None or case[0] in opts.formats]
+
+    directory = tempfile.mkdtemp()
+    try:
+        results = benchmark(opts.count, opts.repeat, directory, cases)
+    finally:
+        shutil.rmtree(directory)
+    print_results(results)
+    if opts.output:
+        with open(opts.output, "w", encoding="utf8") as fh:
+            json.dump({"count": opts.count, "repeat": opts.repeat,
+                       "python": platform.python_version(), "platform": platform.platform(),
+                       "time": datetime.datetime.now().isoformat(timespec="seconds"),
+                       "results": results}, fh, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,41 @@
+import array
+import bisect
+import bz2
+import collections
+import concurrent.futures
 import datetime
+import functools
+import glob
 import gzip
+import io
+import itertools
+import lzma
+import mmap
+import optparse
 import pickle
 import os
+import queue
 
 import sys
 
 import struct
 
 import textwrap
+import threading
+
+import time
 
 import re
-import xml
+import xml.etree.ElementTree
+import xml.sax.saxutils
+import zlib
 
 # magic number: a sequence of one or more bytes at the beginning of a file
 # that is used to indicate the file's type
-GZIP_MAGIC = b"\x1F\x88"
+GZIP_MAGIC = b"\x1F\x8B"
+# gzip's default level 9 is very slow on the long runs of narrative text in
+# a columnar pickle for hardly any saving
+PICKLE_COMPRESS_LEVEL = 6
 
 MAGIC = b"AIB\x00"  # for custom raw binary file
 FORMAT_VERSION = b"\x00\x01"  # for custom raw binary file
@@ -23,12 +44,177 @@ FORMAT_VERSION = b"\x00\x01"  # for custom raw binary file
 # i: 32-bit signed integer
 # ?: boolean
 NumbersStruct = struct.Struct("<Idi?")
+UInt16Struct = struct.Struct("<H")  # little-endian, 16-bit unsigned: every string's length prefix
+
+# version 2 files hold the same records as version 1 but in independently
+# compressed blocks; the version is followed by one byte giving the codec, and
+# each block by a header and then its compressed records
+BLOCK_FORMAT_VERSION = b"\x00\x02"
+# version 3 files keep each distinct airport, aircraft_id and aircraft_type
+# once, in a string table after the records; records refer to them by varint
+# number and the file ends with the string table's offset
+STRING_TABLE_FORMAT_VERSION = b"\x00\x03"
+FORMAT_VERSIONS = (FORMAT_VERSION, BLOCK_FORMAT_VERSION, STRING_TABLE_FORMAT_VERSION)  # the versions we can read
+# key: codec name, value: (codec byte, compress function, decompress function)
+BLOCK_CODECS = {"none": (0, bytes, bytes),
+                "zlib": (1, zlib.compress, zlib.decompress),
+                "lzma": (2, lzma.compress, lzma.decompress),
+                "bz2": (3, bz2.compress, bz2.decompress)}
+BLOCK_SIZE = 1024 * 1024  # a block is closed once its records reach this many bytes
+# the number of records, the minimum and maximum date ordinals, and the size
+# of the compressed records that follow
+BlockHeaderStruct = struct.Struct("<IIII")
+StringTableFooterStruct = struct.Struct("<Q")  # the string table's offset from the start of the file
+
+TEXT_CHUNK_SIZE = 256 * 1024  # the number of bytes iter_text() reads at a time
+NARRATIVE_CACHE_SIZE = 1024  # the number of decoded lazy narratives each NarrativeSource keeps
+FAN_OUT_BATCH_SIZE = 256  # the number of incidents fan_out() hands to each writer at a time
+FAN_OUT_QUEUE_SIZE = 8  # the number of batches that may wait for each writer
+
+INDEX_MAGIC = b"AII\x00"  # for the optional .aib index sidecar
+INDEX_SUFFIX = ".idx"  # the index for incidents.aib is incidents.aib.idx
+# version 2 indexes hold fixed-width entries sorted by report_id, so a
+# lookup bisects the mapped file instead of reading all of it; version 1
+# indexes (length-prefixed report_ids in file order) are ignored
+INDEX_FORMAT_VERSION = b"\x00\x02"
+# the number of entries and the width in bytes every entry's UTF-8
+# report_id is padded to with NULs; each entry's IndexEntryStruct follows it
+IndexHeaderStruct = struct.Struct("<IH")
+# Q: 64-bit unsigned integer, the record's byte offset in the uncompressed data
+# I: the record's date ordinal
+IndexEntryStruct = struct.Struct("<QI")
+
+NARRATIVE_INDEX_MAGIC = b"AIN\x00"  # for the optional narrative index sidecar
+NARRATIVE_INDEX_SUFFIX = ".nix"  # the index for incidents.aib is incidents.aib.nix
+UInt32Struct = struct.Struct("<I")
+
+LOG_MAGIC = b"AIL\x00"  # for the append-only incident log
+LOG_FORMAT_VERSION = b"\x00\x01"
+# every log entry starts with its kind (one of the LOG_ kinds below), the
+# size of its payload, the CRC-32 of the payload and the CRC-32 of these three
+LogEntryStruct = struct.Struct("<BIII")
+LogEntryCheckedStruct = struct.Struct("<BII")  # the part of the entry header the header CRC covers
+LOG_PUT = 1  # payload: the incident's record, as in a version 1 .aib file
+LOG_DELETE = 2  # payload: the length-prefixed report_id
+LOG_CHECKPOINT = 3  # payload: UInt32, the number of incidents live at this point
+LOG_KINDS = (LOG_PUT, LOG_DELETE, LOG_CHECKPOINT)
+LOG_CHECKPOINT_EVERY = 1000  # the number of entries between automatic checkpoints
 
 
 class IncidentError(Exception): pass
 
 
+def _unpickle_incident(report_id, ordinal, airport, aircraft_id, aircraft_type, pilot_percent_hours_on_type,
+                       pilot_total_hours, midair, narrative):
+    return Incident.from_trusted_fields(report_id, datetime.date.fromordinal(ordinal), airport, aircraft_id,
+                                        aircraft_type, pilot_percent_hours_on_type, pilot_total_hours, midair,
+                                        narrative)
+
+
+def _pickle_column(typecode, values):
+    # an array if every value fits the typecode, otherwise a list, since
+    # Incident() accepts e.g. a float pilot_total_hours
+    try:
+        return array.array(typecode, values)
+    except (TypeError, OverflowError):
+        return values
+
+
+def _unpickle_collection(keys, report_ids, ordinals, strings, airport_ids, aircraft_id_ids, aircraft_type_ids,
+                         pilot_percent_hours_on_type, pilot_total_hours, midairs, narratives):
+    # the inverse of IncidentCollection.__reduce__()
+    incidents = IncidentCollection()
+    make = Incident.from_trusted_fields
+    fromordinal = datetime.date.fromordinal
+    strings = [sys.intern(string) for string in strings]
+    dates = {}  # key: ordinal, value: date; incidents on the same day share one
+    setitem = dict.__setitem__  # a new collection has no caches or indexes to update
+    for (key, report_id, ordinal, airport_id, aircraft_id_id, aircraft_type_id, percent, total, midair,
+         narrative) in zip(keys, report_ids, ordinals, airport_ids, aircraft_id_ids, aircraft_type_ids,
+                           pilot_percent_hours_on_type, pilot_total_hours, midairs, narratives):
+        date = dates.get(ordinal)
+        if date is None:
+            date = dates[ordinal] = fromordinal(ordinal)
+        setitem(incidents, key, make(report_id, date, strings[airport_id], strings[aircraft_id_id],
+                                     strings[aircraft_type_id], percent, total, bool(midair), narrative))
+    return incidents
+
+
+def _same_file(filename, other):
+    # False if either file doesn't exist (yet)
+    try:
+        return os.path.samefile(filename, other)
+    except EnvironmentError:
+        return False
+
+
+class NarrativeSource:
+    """
+    the file that an import's lazy narratives are read from
+
+    Each narrative is read and decoded when it is first asked for; the most
+    recently used cache_size of them are kept. The file is held open until
+    close(), and reopened if a narrative is asked for after that. Reading
+    from a file that has changed since the import raises ValueError, so
+    IncidentCollection's exporters read the narratives from a file before
+    writing over it, and close its source. A source may be read from several
+    threads at once, e.g. by fan_out()'s writers.
+    """
+
+    def __init__(self, filename, decode, cache_size=NARRATIVE_CACHE_SIZE):
+        """
+        :param filename:
+        :param decode: turns a narrative's bytes into its text
+        :param cache_size:
+        """
+        self.filename = filename
+        self.__decode = decode
+        self.__fh = open(filename, "rb")
+        self.__stat = self.__signature()
+        self.__lock = threading.Lock()  # a seek() and its read() must not be split up
+        self.narrative = functools.lru_cache(maxsize=cache_size)(self.__read)
+
+    def __signature(self):
+        stat = os.fstat(self.__fh.fileno())
+        return stat.st_size, stat.st_mtime_ns
+
+    def __read(self, offset, length):
+        with self.__lock:
+            if self.__fh is None:
+                self.__fh = open(self.filename, "rb")
+            if self.__signature() != self.__stat:
+                raise ValueError("{0} has changed since its incidents were read".format(self.filename))
+            self.__fh.seek(offset)
+            data = self.__fh.read(length)
+        return self.__decode(data)
+
+    def close(self):
+        with self.__lock:
+            if self.__fh is not None:
+                self.__fh.close()
+                self.__fh = None
+
+
+class LazyNarrative:
+    """a narrative that hasn't been read yet: length bytes at offset in source's file"""
+
+    __slots__ = ("source", "offset", "length")
+
+    def __init__(self, source, offset, length):
+        self.source = source
+        self.offset = offset
+        self.length = length
+
+    def load(self):
+        return self.source.narrative(self.offset, self.length)
+
+
 class Incident:
+    # no per-instance __dict__: millions of incidents may be held at once
+    # (the names are mangled just like the attributes, e.g. _Incident__date)
+    __slots__ = ("__report_id", "__date", "__airport", "__aircraft_id", "__aircraft_type",
+                 "__pilot_percent_hours_on_type", "__pilot_total_hours", "__midair", "__narrative")
+
     def __init__(self, report_id, date, airport, aircraft_id, aircraft_type, pilot_percent_hours_on_type,
                  pilot_total_hours, midair, narrative=""):
         assert len(report_id) >= 8 and len(report_id.split()) == 1, "invalid report ID"  # no white space
@@ -43,15 +229,54 @@ class Incident:
         self.midair = midair
         self.narrative = narrative
 
+    @classmethod
+    def from_trusted_fields(cls, report_id, date, airport, aircraft_id, aircraft_type,
+                            pilot_percent_hours_on_type, pilot_total_hours, midair, narrative=""):
+        """
+        create an Incident without validating its fields
+
+        only for data that has already been validated, e.g. records read back
+        from a file written by one of the export methods; user input must go
+        through Incident() so that the property setters check it
+        """
+        incident = object.__new__(cls)
+        incident.__report_id = report_id
+        incident.__date = date
+        incident.__airport = airport
+        incident.__aircraft_id = aircraft_id
+        incident.__aircraft_type = aircraft_type
+        incident.__pilot_percent_hours_on_type = pilot_percent_hours_on_type
+        incident.__pilot_total_hours = pilot_total_hours
+        incident.__midair = midair
+        incident.__narrative = narrative
+        return incident
+
+    def __reduce__(self):
+        # pickled as a plain tuple of field values, with the date as its
+        # ordinal and a lazy narrative as its text, rather than as a dict
+        # of mangled attribute names
+        return _unpickle_incident, (self.__report_id, self.__date.toordinal(), self.__airport,
+                                    self.__aircraft_id, self.__aircraft_type,
+                                    self.__pilot_percent_hours_on_type, self.__pilot_total_hours,
+                                    self.__midair, self.narrative)
+
+    def __setstate__(self, state):
+        # only for older pickles: those made before Incident had __slots__
+        # hold a plain __dict__, later ones a (None, slots dict) pair
+        if isinstance(state, tuple):
+            state = state[1]
+        for name, value in state.items():
+            object.__setattr__(self, name, value)
+
     @property
     def report_id(self):
         return self.__report_id
 
-    @property.getter  # getter could be omitted
+    @property  # getter
     def date(self):
         return self.__date
 
-    @property.setter  # property for value invalidation
+    @date.setter  # property for value validation
     def date(self, date):
         assert isinstance(date, datetime.date), "invalid date"
         self.__date = date
@@ -60,7 +285,7 @@ class Incident:
     def airport(self):
         return self.__airport
 
-    @property.setter
+    @airport.setter
     def airport(self, airport):
         assert airport and "\n" not in airport, "invalid airport"  # airport nonempty and no newlines
         self.__airport = airport
@@ -69,7 +294,7 @@ class Incident:
     def aircraft_id(self):
         return self.__aircraft_id
 
-    @property.setter
+    @aircraft_id.setter
     def aircraft_id(self, aircraft_id):
         assert aircraft_id and "\n" not in aircraft_id, "invalid aircraft_id"  # aircraft_id nonempty and no newlines
         self.__aircraft_id = aircraft_id
@@ -78,7 +303,7 @@ class Incident:
     def aircraft_type(self):
         return self.__aircraft_type
 
-    @property.setter
+    @aircraft_type.setter
     def aircraft_type(self, aircraft_type):
         assert aircraft_type and "\n" not in aircraft_type, "invalid aircraft_type"
         self.__aircraft_type = aircraft_type
@@ -87,40 +312,1744 @@ class Incident:
     def pilot_percent_hours_on_type(self):
         return self.__pilot_percent_hours_on_type
 
-    @property.setter
+    @pilot_percent_hours_on_type.setter
     def pilot_percent_hours_on_type(self, pilot_percent_hours_on_type):
         assert 0 <= pilot_percent_hours_on_type <= 100.0, "out of range percentage"  # between 0.0 and 100.0
         self.__pilot_percent_hours_on_type = pilot_percent_hours_on_type
 
-    @property
-    def pilot_total_hours(self):
-        return self.__pilot_total_hours
+    @property
+    def pilot_total_hours(self):
+        return self.__pilot_total_hours
+
+    @pilot_total_hours.setter
+    def pilot_total_hours(self, pilot_total_hours):
+        assert pilot_total_hours > 0, "invalid number of hours"
+        self.__pilot_total_hours = pilot_total_hours
+
+    @property
+    def midair(self):
+        return self.__midair
+
+    @midair.setter
+    def midair(self, midair):
+        assert isinstance(midair, bool), "invalid midair value"
+        self.__midair = midair
+
+    @property
+    def narrative(self):
+        narrative = self.__narrative
+        if narrative.__class__ is LazyNarrative:
+            return narrative.load()
+        return narrative
+
+    @narrative.setter
+    def narrative(self, narrative):
+        self.__narrative = narrative
+
+    @property
+    def narrative_source(self):
+        """the NarrativeSource the narrative is still to be read from, or None"""
+        narrative = self.__narrative
+        if narrative.__class__ is LazyNarrative:
+            return narrative.source
+        return None
+
+    @property
+    def approximate_hours_on_type(self):
+        return int(self.__pilot_total_hours * self.__pilot_percent_hours_on_type / 100)
+
+
+# the Incident initializer's arguments, in order
+FIELD_NAMES = ("report_id", "date", "airport", "aircraft_id", "aircraft_type",
+               "pilot_percent_hours_on_type", "pilot_total_hours", "midair", "narrative")
+
+
+def format_text(incident, wrapper):
+    """
+    the .ait text form of one incident
+
+    :param incident:
+    :param wrapper: the textwrap.TextWrapper used to indent the narrative
+    """
+    narrative = "\n".join(wrapper.wrap(incident.narrative.strip()))
+    return ("[{0.report_id}]\n"
+            # !s to force string form, !r to force representational form,
+            # !a to force representational form but only using ascii characters
+            "date={0.date!s}\n"
+            "aircraft_id={0.aircraft_id}\n"
+            "aircraft_type={0.aircraft_type}\n"
+            "airport={airport}\n"
+            "pilot_percent_hours_on_type={0.pilot_percent_hours_on_type}\n"
+            "pilot_total_hours={0.pilot_total_hours}\n"
+            "midair={0.midair:d}\n"  # bool as integer
+            ".NARRATIVE_START.\n"
+            "{narrative}\n"
+            ".NARRATIVE_END.\n"
+            "\n".format(incident, airport=incident.airport.strip(), narrative=narrative))
+
+
+def pack_string(string):
+    data = string.encode("utf8")
+    # to hold a struct format based on the string's length.
+    # h: 16-bit signed integer, H: 16-bit unsigned integer
+    # <: little-endian
+    # >: big-endian
+    format = "<H{0}s".format(len(data))
+    return struct.pack(format, len(data), data)
+
+
+def unpack_string(fh, eof_is_error=True):
+    length_data = fh.read(UInt16Struct.size)
+    if not length_data:  # null
+        if eof_is_error:
+            raise ValueError("missing or corrupt string size")
+        return None
+    if len(length_data) != UInt16Struct.size:
+        raise ValueError("missing or corrupt string size")
+    length = UInt16Struct.unpack(length_data)[0]
+    if length == 0:
+        return ""
+    data = fh.read(length)
+    if not data or len(data) != length:
+        raise ValueError("missing or corrupt string")
+    return data.decode("utf8")
+
+
+def pack_varint(number):
+    """an unsigned integer as a little-endian base 128 varint: 7 bits a byte, high bit set on all but the last"""
+    data = bytearray()
+    while number >= 0x80:
+        data.append((number & 0x7F) | 0x80)
+        number >>= 7
+    data.append(number)
+    return data
+
+
+def unpack_varint_from(buffer, offset):
+    """
+    read a varint written by pack_varint()
+
+    :return: (number, the offset just past it)
+    """
+    number = shift = 0
+    while True:
+        byte = buffer[offset]
+        offset += 1
+        number |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return number, offset
+        shift += 7
+
+
+def open_binary(filename):
+    """
+    open a file for binary reading, whether it is gzip-compressed or not
+
+    :param filename:
+    :return: a file object positioned at the start of the (uncompressed) data
+    """
+    fh = open(filename, "rb")  # the file may or may not compressed
+    magic = fh.read(len(GZIP_MAGIC))  # read the first two bytes
+    if magic == GZIP_MAGIC:
+        fh.close()
+        fh = gzip.open(filename, "rb")
+    else:
+        fh.seek(0)
+    return fh
+
+
+def read_binary_header(fh):
+    magic = fh.read(len(MAGIC))
+    if magic != MAGIC:  # isn't a binary aircraft incident data file
+        raise ValueError("invalid .aib file format")
+    version = fh.read(len(FORMAT_VERSION))  # read 2 bytes version number
+    if version not in FORMAT_VERSIONS:  # e.g. a later one
+        raise ValueError("unrecognized .aib file version")
+    return version
+
+
+def read_block_codec(fh):
+    """read a version 2 file's codec byte and return its decompress function"""
+    codec = fh.read(1)
+    for id, compress, decompress in BLOCK_CODECS.values():
+        if codec == bytes((id,)):
+            return decompress
+    raise ValueError("unrecognized .aib block codec")
+
+
+def pack_record(incident):
+    data = bytearray()
+    data.extend(pack_string(incident.report_id))
+    data.extend(pack_string(incident.airport))
+    data.extend(pack_string(incident.aircraft_id))
+    data.extend(pack_string(incident.aircraft_type))
+    data.extend(pack_string(incident.narrative.strip()))
+    data.extend(NumbersStruct.pack(
+        incident.date.toordinal(),
+        incident.pilot_percent_hours_on_type,
+        incident.pilot_total_hours,
+        incident.midair
+    ))
+    return data
+
+
+def unpack_record(fh):
+    """
+    read the next record from a version 1 .aib file
+
+    :param fh: a binary file object positioned at the start of a record
+    :return: a tuple of field values in FIELD_NAMES order, or None at end of file
+    """
+    report_id = unpack_string(fh, False)
+    if report_id is None:
+        return None
+    airport, aircraft_id, aircraft_type, narrative = (unpack_string(fh) for _ in range(4))
+    other_data = fh.read(NumbersStruct.size)
+    if len(other_data) != NumbersStruct.size:
+        raise ValueError("missing or corrupt numbers")
+    # NumbersStruct = struct.Struct("<Idi?")
+    ordinal, pilot_percent_hours_on_type, pilot_total_hours, midair = NumbersStruct.unpack(other_data)
+    return (report_id, datetime.date.fromordinal(ordinal), airport, aircraft_id, aircraft_type,
+            pilot_percent_hours_on_type, pilot_total_hours, midair, narrative)
+
+
+def iter_binary(filename, first_date=None, last_date=None, max_workers=None, lazy_narratives=False):
+    """
+    read an .aib file one incident at a time
+
+    The file is opened and its header checked straight away, so a missing
+    or invalid file raises here rather than on the first next(); the records
+    themselves are only read as the returned generator is consumed, so memory
+    use does not grow with the size of the file.
+
+    :param filename: an .aib file, gzip-compressed or not
+    :param first_date: if given, skip incidents before this date
+    :param last_date: if given, skip incidents after this date
+    :param max_workers: for version 2 files, decompress this many blocks at
+                        a time in a pool of threads
+    :param lazy_narratives: leave each narrative in the file until it is
+                            first used (see NarrativeSource); only for
+                            uncompressed version 1 and 3 files, others are
+                            read in full
+    :return: a generator of Incidents in file order
+    """
+    return _iter_binary_file(filename, Incident.from_trusted_fields, lazy_narratives, first_date, last_date,
+                             max_workers, lazy_narratives)
+
+
+def iter_binary_mmap(filename):
+    """
+    read an .aib file one incident at a time by memory-mapping it
+
+    Instead of two read() calls per string this walks the mapped file with
+    the precompiled structs' unpack_from(), decoding each string straight
+    from the map. Uncompressed version 1 and 3 files are mapped (version 3
+    files always are, as iter_binary() maps them too); gzipped and version
+    2 files are read as by iter_binary().
+
+    :param filename: an .aib file
+    :return: a generator of Incidents in file order
+    """
+    return _iter_binary_file(filename, Incident.from_trusted_fields, True)
+
+
+def iter_binary_fields(filename):
+    """
+    read an .aib file one record at a time without creating Incidents
+
+    :param filename: an .aib file, gzip-compressed or not
+    :return: a generator of tuples of field values in FIELD_NAMES order
+    """
+    return _iter_binary_file(filename, _fields, True)
+
+
+def _fields(*fields):
+    return fields
+
+
+def _decode_utf8(data):
+    return data.decode("utf8")
+
+
+def _iter_binary_file(filename, make, mapped, first_date=None, last_date=None, max_workers=None,
+                      lazy_narratives=False):
+    # make is called with each record's field values in FIELD_NAMES order
+    first = first_date.toordinal() if first_date is not None else 0
+    last = last_date.toordinal() if last_date is not None else datetime.date.max.toordinal()
+    fh = open_binary(filename)
+    source = None
+    try:
+        version = read_binary_header(fh)
+        if lazy_narratives and version != BLOCK_FORMAT_VERSION and not isinstance(fh, gzip.GzipFile):
+            source = NarrativeSource(filename, _decode_utf8)
+        if version == BLOCK_FORMAT_VERSION:
+            decompress = read_block_codec(fh)
+            return _iter_block_records(fh, decompress, make, first, last, max_workers)
+        if version == STRING_TABLE_FORMAT_VERSION:
+            # the string table is at the end, so the whole file is needed:
+            # mapped if possible, otherwise (gzip) read into memory
+            offset = fh.tell()
+            if isinstance(fh, gzip.GzipFile):
+                fh.seek(0)
+                buffer = fh.read()
+            else:
+                buffer = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            return _iter_string_table_records(fh, buffer, offset, make, first, last, source)
+        if mapped and not isinstance(fh, gzip.GzipFile):
+            offset = fh.tell()
+            mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            return _iter_mmap_records(fh, mm, offset, make, first, last, source)
+    except:
+        fh.close()
+        if source is not None:
+            source.close()
+        raise
+    return _iter_binary_records(fh, make, first, last)
+
+
+def _iter_binary_records(fh, make, first, last):
+    try:
+        while True:
+            fields = unpack_record(fh)
+            if fields is None:
+                break
+            if first <= fields[1].toordinal() <= last:
+                yield make(*fields)
+    finally:
+        fh.close()
+
+
+def _iter_mmap_records(fh, mm, offset, make, first, last, source=None):
+    try:
+        yield from _iter_buffer_records(mm, offset, make, first, last, source)
+    finally:
+        mm.close()
+        fh.close()
+
+
+def _iter_buffer_records(buffer, offset, make, first, last, source=None):
+    # buffer is an mmap or a decompressed block holding version 1 records;
+    # given a NarrativeSource for the mapped file, narratives are left unread
+    size = len(buffer)
+    # local names for everything used in the loop
+    unpack_length = UInt16Struct.unpack_from
+    length_size = UInt16Struct.size
+    unpack_numbers = NumbersStruct.unpack_from
+    numbers_size = NumbersStruct.size
+    fromordinal = datetime.date.fromordinal
+    try:
+        while offset < size:
+            strings = []
+            for _ in range(5):  # report_id, airport, aircraft_id, aircraft_type, narrative
+                length = unpack_length(buffer, offset)[0]
+                offset += length_size
+                end = offset + length
+                if end > size:
+                    raise ValueError("missing or corrupt string")
+                if source is not None and len(strings) == 4:
+                    strings.append(LazyNarrative(source, offset, length))
+                else:
+                    # slicing the map and decoding is quicker than going through a
+                    # memoryview slice for strings this short
+                    strings.append(buffer[offset:end].decode("utf8"))
+                offset = end
+            ordinal, percent, total, midair = unpack_numbers(buffer, offset)
+            offset += numbers_size
+            if first <= ordinal <= last:
+                report_id, airport, aircraft_id, aircraft_type, narrative = strings
+                yield make(report_id, fromordinal(ordinal), airport, aircraft_id, aircraft_type,
+                           percent, total, midair, narrative)
+    except struct.error as err:  # unpack_from() ran off the end of the data
+        raise ValueError("missing or corrupt record: {0}".format(err))
+
+
+def _read_string_table(buffer, offset):
+    # returns the interned strings and the offset where the records end
+    try:
+        end = StringTableFooterStruct.unpack_from(buffer, len(buffer) - StringTableFooterStruct.size)[0]
+        if not offset <= end <= len(buffer) - StringTableFooterStruct.size:
+            raise ValueError("missing or corrupt string table offset")
+        position = end
+        count = UInt32Struct.unpack_from(buffer, position)[0]
+        position += UInt32Struct.size
+        strings = []
+        for _ in range(count):
+            length = UInt16Struct.unpack_from(buffer, position)[0]
+            position += UInt16Struct.size
+            strings.append(sys.intern(buffer[position:position + length].decode("utf8")))
+            position += length
+    except struct.error as err:
+        raise ValueError("missing or corrupt string table: {0}".format(err))
+    return strings, end
+
+
+def _iter_string_table_records(fh, buffer, offset, make, first, last, source=None):
+    # like _iter_buffer_records() but airport, aircraft_id and aircraft_type
+    # are varint numbers into the string table
+    unpack_length = UInt16Struct.unpack_from
+    length_size = UInt16Struct.size
+    unpack_numbers = NumbersStruct.unpack_from
+    numbers_size = NumbersStruct.size
+    fromordinal = datetime.date.fromordinal
+    try:
+        strings, size = _read_string_table(buffer, offset)
+        while offset < size:
+            length = unpack_length(buffer, offset)[0]
+            offset += length_size
+            report_id = buffer[offset:offset + length].decode("utf8")
+            offset += length
+            ids = []
+            for _ in range(3):  # airport, aircraft_id, aircraft_type
+                id = buffer[offset]
+                if id < 0x80:  # nearly every table has fewer than 128 strings of each kind
+                    offset += 1
+                else:
+                    id, offset = unpack_varint_from(buffer, offset)
+                ids.append(id)
+            length = unpack_length(buffer, offset)[0]
+            offset += length_size
+            end = offset + length
+            if end > size:
+                raise ValueError("missing or corrupt string")
+            if source is not None:
+                narrative = LazyNarrative(source, offset, length)
+            else:
+                narrative = buffer[offset:end].decode("utf8")
+            offset = end
+            ordinal, percent, total, midair = unpack_numbers(buffer, offset)
+            offset += numbers_size
+            if first <= ordinal <= last:
+                yield make(report_id, fromordinal(ordinal), strings[ids[0]], strings[ids[1]],
+                           strings[ids[2]], percent, total, midair, narrative)
+    except (struct.error, IndexError) as err:  # ran off the end of the data or the table
+        raise ValueError("missing or corrupt record: {0}".format(err))
+    finally:
+        if isinstance(buffer, mmap.mmap):
+            buffer.close()
+        fh.close()
+
+
+def _read_blocks(fh, first, last):
+    # yields the compressed records of every block that may hold incidents
+    # dated first..last; the others are skipped over without being read
+    while True:
+        header = fh.read(BlockHeaderStruct.size)
+        if not header:
+            break
+        if len(header) != BlockHeaderStruct.size:
+            raise ValueError("missing or corrupt block header")
+        count, minimum, maximum, size = BlockHeaderStruct.unpack(header)
+        if maximum < first or minimum > last:
+            fh.seek(size, os.SEEK_CUR)
+            continue
+        payload = fh.read(size)
+        if len(payload) != size:
+            raise ValueError("missing or corrupt block")
+        yield payload
+
+
+def _iter_block_records(fh, decompress, make, first, last, max_workers):
+    try:
+        if max_workers is None:
+            for payload in _read_blocks(fh, first, last):
+                yield from _iter_buffer_records(decompress(payload), 0, make, first, last)
+        else:
+            # zlib, lzma and bz2 release the GIL, so blocks can be decompressed
+            # in parallel; only a few are in flight at once to keep memory flat
+            with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+                pending = collections.deque()
+                for payload in _read_blocks(fh, first, last):
+                    pending.append(executor.submit(decompress, payload))
+                    if len(pending) > max_workers:
+                        yield from _iter_buffer_records(pending.popleft().result(), 0, make, first, last)
+                while pending:
+                    yield from _iter_buffer_records(pending.popleft().result(), 0, make, first, last)
+    except (zlib.error, lzma.LZMAError, OSError) as err:  # bz2 raises OSError
+        raise ValueError("corrupt block: {0}".format(err))
+    finally:
+        fh.close()
+
+
+class BinaryIncidentWriter:
+    """
+    write an .aib file incrementally, one incident at a time
+
+    writer = BinaryIncidentWriter(filename)
+    for incident in incidents:
+        writer.write(incident)
+    writer.close()
+
+    can also be used as a context manager; if index is True an index
+    sidecar (filename + INDEX_SUFFIX) is written alongside the data
+    """
+
+    def __init__(self, filename, compress=False, index=False):
+        self.__index_fh = None
+        self.__index_entries = None  # (report_id, offset, ordinal), written sorted by close()
+        if compress:
+            self.__fh = gzip.open(filename, "wb")
+        else:
+            self.__fh = open(filename, "wb")
+        self.count = 0
+        try:
+            self.__fh.write(MAGIC)
+            self.__fh.write(FORMAT_VERSION)
+            # offsets are into the uncompressed data, so they are the same
+            # whether or not the file is gzipped
+            self.offset = len(MAGIC) + len(FORMAT_VERSION)
+            if index:
+                self.__index_fh = open(filename + INDEX_SUFFIX, "wb")
+                self.__index_entries = []
+        except:
+            self.close()
+            raise
+
+    def write(self, incident):
+        data = pack_record(incident)
+        self.__fh.write(data)
+        if self.__index_entries is not None:
+            self.__index_entries.append((incident.report_id.encode("utf8"), self.offset,
+                                         incident.date.toordinal()))
+        self.offset += len(data)
+        self.count += 1
+
+    def close(self):
+        # the data file is closed first so that the index is never older than it
+        if self.__fh is not None:
+            self.__fh.close()
+            self.__fh = None
+        if self.__index_fh is not None:
+            try:
+                self.__write_index()
+            finally:
+                self.__index_fh.close()
+                self.__index_fh = None
+                self.__index_entries = None
+
+    def __write_index(self):
+        entries = sorted(self.__index_entries)  # UTF-8 bytes sort as their strings do
+        width = max((len(report_id) for report_id, offset, ordinal in entries), default=0)
+        self.__index_fh.write(INDEX_MAGIC)
+        self.__index_fh.write(INDEX_FORMAT_VERSION)
+        self.__index_fh.write(IndexHeaderStruct.pack(len(entries), width))
+        for report_id, offset, ordinal in entries:
+            self.__index_fh.write(report_id.ljust(width, b"\0"))
+            self.__index_fh.write(IndexEntryStruct.pack(offset, ordinal))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class BlockIncidentWriter:
+    """
+    write a version 2 .aib file incrementally, one incident at a time
+
+    Records are gathered into blocks of about block_size bytes, each of which
+    is compressed on its own with the given codec (see BLOCK_CODECS) and
+    preceded by a header giving its number of records and date range, so
+    readers can skip blocks or decompress them in parallel.
+
+    can also be used as a context manager
+    """
+
+    def __init__(self, filename, codec="zlib", block_size=BLOCK_SIZE):
+        if codec not in BLOCK_CODECS:
+            raise ValueError("unrecognized .aib block codec {0}".format(codec))
+        id, self.__compress, decompress = BLOCK_CODECS[codec]
+        self.block_size = block_size
+        self.count = 0
+        self.__block = bytearray()
+        self.__block_count = 0
+        self.__minimum = self.__maximum = None
+        self.__fh = open(filename, "wb")
+        try:
+            self.__fh.write(MAGIC)
+            self.__fh.write(BLOCK_FORMAT_VERSION)
+            self.__fh.write(bytes((id,)))
+        except:
+            self.__fh.close()
+            raise
+
+    def write(self, incident):
+        ordinal = incident.date.toordinal()
+        self.__block.extend(pack_record(incident))
+        if self.__block_count == 0:
+            self.__minimum = self.__maximum = ordinal
+        else:
+            self.__minimum = min(self.__minimum, ordinal)
+            self.__maximum = max(self.__maximum, ordinal)
+        self.__block_count += 1
+        self.count += 1
+        if len(self.__block) >= self.block_size:
+            self.__write_block()
+
+    def __write_block(self):
+        payload = self.__compress(self.__block)
+        self.__fh.write(BlockHeaderStruct.pack(self.__block_count, self.__minimum, self.__maximum,
+                                               len(payload)))
+        self.__fh.write(payload)
+        self.__block = bytearray()
+        self.__block_count = 0
+
+    def close(self):
+        if self.__fh is not None:
+            try:
+                if self.__block_count:
+                    self.__write_block()
+            finally:
+                self.__fh.close()
+                self.__fh = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class StringTableIncidentWriter:
+    """
+    write a version 3 .aib file incrementally, one incident at a time
+
+    Each distinct airport, aircraft_id and aircraft_type is written once, in
+    the string table that close() writes after the records; records hold
+    their varint numbers instead.
+
+    can also be used as a context manager
+    """
+
+    def __init__(self, filename, compress=False):
+        if compress:
+            self.__fh = gzip.open(filename, "wb")
+        else:
+            self.__fh = open(filename, "wb")
+        self.count = 0
+        self.__strings = StringPool()
+        try:
+            self.__fh.write(MAGIC)
+            self.__fh.write(STRING_TABLE_FORMAT_VERSION)
+            self.offset = len(MAGIC) + len(STRING_TABLE_FORMAT_VERSION)
+        except:
+            self.close()
+            raise
+
+    def write(self, incident):
+        data = bytearray()
+        data.extend(pack_string(incident.report_id))
+        data.extend(pack_varint(self.__strings.add(incident.airport)))
+        data.extend(pack_varint(self.__strings.add(incident.aircraft_id)))
+        data.extend(pack_varint(self.__strings.add(incident.aircraft_type)))
+        data.extend(pack_string(incident.narrative.strip()))
+        data.extend(NumbersStruct.pack(incident.date.toordinal(), incident.pilot_percent_hours_on_type,
+                                       incident.pilot_total_hours, incident.midair))
+        self.__fh.write(data)
+        self.offset += len(data)
+        self.count += 1
+
+    def close(self):
+        if self.__fh is not None:
+            try:
+                self.__fh.write(UInt32Struct.pack(len(self.__strings)))
+                for string in self.__strings:
+                    self.__fh.write(pack_string(string))
+                self.__fh.write(StringTableFooterStruct.pack(self.offset))
+            finally:
+                self.__fh.close()
+                self.__fh = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class IncidentIndex:
+    """
+    the report_id -> (offset, date ordinal) map of an .aib index sidecar
+
+    The sidecar is memory-mapped and bisected, so a lookup reads only a
+    few of its pages; call close() (or use a with statement) when done.
+    """
+
+    def __init__(self, buffer, start, count, width):
+        """
+        :param buffer: the index file's data
+        :param start: the offset of the first entry in buffer
+        :param count: the number of entries
+        :param width: the width of each entry's padded report_id
+        """
+        self.__buffer = buffer
+        self.__start = start
+        self.__count = count
+        self.__width = width
+        self.__entry_size = width + IndexEntryStruct.size
+        # (ordinal, offset) pairs in date order, for bisecting by date; only
+        # built when first needed since lookups don't need them
+        self.__by_date = None
+
+    @classmethod
+    def load(cls, filename):
+        """
+        open the index for the given .aib file
+
+        :param filename: the .aib file (not the index file itself)
+        :return: an IncidentIndex, or None if there is no usable index
+        """
+        index_filename = filename + INDEX_SUFFIX
+        # an index older than its data file belongs to an earlier export
+        if (not os.path.exists(index_filename) or
+                os.path.getmtime(index_filename) < os.path.getmtime(filename)):
+            return None
+        fh = open(index_filename, "rb")
+        try:
+            header = fh.read(len(INDEX_MAGIC) + len(INDEX_FORMAT_VERSION) + IndexHeaderStruct.size)
+            if not header.startswith(INDEX_MAGIC):
+                raise ValueError("invalid .aib index file format")
+            if header[len(INDEX_MAGIC):len(INDEX_MAGIC) + len(INDEX_FORMAT_VERSION)] != INDEX_FORMAT_VERSION:
+                return None  # an older index: the data file is scanned instead
+            if len(header) != len(INDEX_MAGIC) + len(INDEX_FORMAT_VERSION) + IndexHeaderStruct.size:
+                raise ValueError("missing or corrupt index header")
+            count, width = IndexHeaderStruct.unpack_from(header, len(INDEX_MAGIC) + len(INDEX_FORMAT_VERSION))
+            if os.fstat(fh.fileno()).st_size != len(header) + count * (width + IndexEntryStruct.size):
+                raise ValueError("missing or corrupt index entries")
+            # the map keeps its own handle to the file
+            buffer = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fh.close()
+        return cls(buffer, len(header), count, width)
+
+    def close(self):
+        if isinstance(self.__buffer, mmap.mmap):
+            self.__buffer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.__count
+
+    def __find(self, report_id):
+        # the position in the buffer of the report's entry's IndexEntryStruct, or None
+        key = report_id.encode("utf8")
+        if len(key) > self.__width:
+            return None
+        key = key.ljust(self.__width, b"\0")
+        buffer, start, size, width = self.__buffer, self.__start, self.__entry_size, self.__width
+        low, high = 0, self.__count
+        while low < high:
+            middle = (low + high) // 2
+            position = start + middle * size
+            if buffer[position:position + width] < key:
+                low = middle + 1
+            else:
+                high = middle
+        position = start + low * size
+        if low < self.__count and buffer[position:position + width] == key:
+            return position + width
+        return None
+
+    def __contains__(self, report_id):
+        return self.__find(report_id) is not None
+
+    def offset(self, report_id):
+        """the byte offset of the given report's record, or None"""
+        position = self.__find(report_id)
+        return IndexEntryStruct.unpack_from(self.__buffer, position)[0] if position is not None else None
+
+    def offsets_between(self, first_date, last_date):
+        """the ascending byte offsets of every record dated first_date..last_date inclusive"""
+        if self.__by_date is None:
+            entries = struct.Struct("<{0}s{1}".format(self.__width, IndexEntryStruct.format.lstrip("<")))
+            end = self.__start + self.__count * self.__entry_size
+            self.__by_date = sorted((ordinal, offset) for report_id, offset, ordinal
+                                    in entries.iter_unpack(self.__buffer[self.__start:end]))
+        left = bisect.bisect_left(self.__by_date, (first_date.toordinal(), 0))
+        right = bisect.bisect_left(self.__by_date, (last_date.toordinal() + 1, 0))
+        return sorted(offset for ordinal, offset in self.__by_date[left:right])
+
+
+def _pack_log_entry(kind, payload):
+    checked = LogEntryCheckedStruct.pack(kind, len(payload), zlib.crc32(payload))
+    return checked + UInt32Struct.pack(zlib.crc32(checked)) + payload
+
+
+def _open_log(filename, mode="rb"):
+    # open an incident log and check its header, leaving it at the first entry
+    fh = open(filename, mode)
+    try:
+        if fh.read(len(LOG_MAGIC)) != LOG_MAGIC:
+            raise ValueError("invalid incident log file format")
+        if fh.read(len(LOG_FORMAT_VERSION)) != LOG_FORMAT_VERSION:
+            raise ValueError("unrecognized incident log file version")
+    except:
+        fh.close()
+        raise
+    return fh
+
+
+def _only_zeros(fh, offset, chunk_size=64 * 1024):
+    # whether everything from offset to the end of the file is zero bytes
+    fh.seek(offset)
+    while True:
+        data = fh.read(chunk_size)
+        if not data:
+            return True
+        if data.count(0) != len(data):
+            return False
+
+
+def _iter_log_entries(fh):
+    """
+    read the entries of an incident log
+
+    A final entry that is cut short, or whose payload checksum fails, is
+    taken to be a write that a crash interrupted: it is ignored and
+    iteration stops. So is an entry header whose checksum fails if the
+    entry it describes would run past the end of the file, or if the rest
+    of the file is zeros (as a crash can leave after the last write). A bad
+    entry anywhere else means the log is corrupt.
+
+    :param fh: a binary file object positioned at the first entry
+    :return: a generator of (kind, payload, offset just past the entry)
+    """
+    offset = fh.tell()
+    size = os.fstat(fh.fileno()).st_size
+    while True:
+        header = fh.read(LogEntryStruct.size)
+        if len(header) != LogEntryStruct.size:
+            return
+        kind, length, crc, header_crc = LogEntryStruct.unpack(header)
+        # without this check a damaged length would look like a torn entry
+        if zlib.crc32(header[:LogEntryCheckedStruct.size]) != header_crc:
+            if offset + LogEntryStruct.size + length > size or _only_zeros(fh, offset):
+                return
+            raise ValueError("corrupt incident log entry header at byte {0}".format(offset))
+        payload = fh.read(length)
+        if len(payload) != length:
+            return
+        end = offset + LogEntryStruct.size + length
+        if zlib.crc32(payload) != crc:
+            if end == size:
+                return
+            raise ValueError("corrupt incident log entry at byte {0}".format(offset))
+        if kind not in LOG_KINDS:
+            raise ValueError("unrecognized incident log entry at byte {0}".format(offset))
+        yield kind, payload, end
+        offset = end
+
+
+def replay_log(filename, incidents=None):
+    """
+    read an incident log, applying its puts and deletes in order
+
+    :param filename:
+    :param incidents: the dict to apply them to (default: a new one)
+    :return: incidents, a dict of report_id -> Incident
+    """
+    if incidents is None:
+        incidents = {}
+    fh = _open_log(filename)
+    try:
+        for kind, payload, end in _iter_log_entries(fh):
+            if kind == LOG_PUT:
+                incident = Incident.from_trusted_fields(*unpack_record(io.BytesIO(payload)))
+                incidents[incident.report_id] = incident
+            elif kind == LOG_DELETE:
+                incidents.pop(unpack_string(io.BytesIO(payload)), None)
+            elif UInt32Struct.unpack(payload)[0] != len(incidents):
+                raise ValueError("incident log checkpoint ending at byte {0} does not match".format(end))
+    finally:
+        fh.close()
+    return incidents
+
+
+def write_log(filename, incidents):
+    """
+    write a compacted incident log: one put for each incident and a checkpoint
+
+    The log is written to a temporary file that then replaces filename, so
+    a crash leaves either the old log or the new one.
+
+    :param filename:
+    :param incidents: an iterable of Incidents with distinct report_ids
+    :return: the number of incidents written
+    """
+    temporary = filename + ".tmp"
+    fh = open(temporary, "wb")
+    try:
+        fh.write(LOG_MAGIC)
+        fh.write(LOG_FORMAT_VERSION)
+        count = 0
+        for incident in incidents:
+            fh.write(_pack_log_entry(LOG_PUT, pack_record(incident)))
+            count += 1
+        fh.write(_pack_log_entry(LOG_CHECKPOINT, UInt32Struct.pack(count)))
+        fh.flush()
+        os.fsync(fh.fileno())
+    except:
+        fh.close()
+        os.remove(temporary)
+        raise
+    fh.close()
+    os.replace(temporary, filename)
+    return count
+
+
+class IncidentLog:
+    """
+    an append-only incident log (.ail) that is added to one entry at a time
+
+    put() and delete() each append one small entry, so changing an
+    incident doesn't mean rewriting the file; replay_log() or
+    IncidentCollection.import_log() rebuild the incidents. Every
+    checkpoint_every entries, and on checkpoint() and close(), the log is
+    flushed to disk with os.fsync() and a checkpoint entry recording the
+    number of live incidents is written. compact() rewrites the log with
+    just the live incidents.
+
+    An entry torn by a crash part-way through a write is ignored by readers
+    and cut off when the log is next opened.
+
+    log = IncidentLog(filename)
+    log.put(incident)
+    log.delete(report_id)
+    log.close()
+
+    can also be used as a context manager, and like the other writers has
+    write(incident) and a count of the incidents written
+    """
+
+    def __init__(self, filename, checkpoint_every=LOG_CHECKPOINT_EVERY, new=False):
+        """
+        :param filename:
+        :param checkpoint_every: the number of entries between automatic
+                                 checkpoints (0 or None: only when asked)
+        :param new: start a new, empty log even if filename exists
+        """
+        self.filename = filename
+        self.checkpoint_every = checkpoint_every
+        self.count = 0
+        self.__live = set()  # the report_ids of the live incidents
+        self.__since_checkpoint = 0
+        self.__fh = None
+        if new or not os.path.exists(filename):
+            self.__fh = open(filename, "wb")
+            self.__fh.write(LOG_MAGIC)
+            self.__fh.write(LOG_FORMAT_VERSION)
+            self.__fh.flush()
+        else:
+            self.__open()
+
+    def __open(self):
+        fh = _open_log(self.filename, "r+b")
+        try:
+            end = fh.tell()
+            for kind, payload, end in _iter_log_entries(fh):
+                if kind == LOG_PUT:
+                    self.__live.add(unpack_string(io.BytesIO(payload)))
+                elif kind == LOG_DELETE:
+                    self.__live.discard(unpack_string(io.BytesIO(payload)))
+            # cut off any torn entry so that new entries follow a whole one
+            fh.seek(end)
+            fh.truncate()
+        except:
+            fh.close()
+            raise
+        self.__fh = fh
+
+    def __append(self, kind, payload):
+        self.__fh.write(_pack_log_entry(kind, payload))
+        self.__fh.flush()
+        self.__since_checkpoint += 1
+
+    def __checkpoint_if_due(self):
+        # only called once __live reflects the latest entry
+        if self.checkpoint_every and self.__since_checkpoint >= self.checkpoint_every:
+            self.checkpoint()
+
+    def put(self, incident):
+        """add the incident, replacing any with the same report_id"""
+        self.__append(LOG_PUT, pack_record(incident))
+        self.__live.add(incident.report_id)
+        self.count += 1
+        self.__checkpoint_if_due()
+
+    write = put
+
+    def delete(self, report_id):
+        if report_id not in self.__live:
+            raise KeyError(report_id)
+        self.__append(LOG_DELETE, pack_string(report_id))
+        self.__live.discard(report_id)
+        self.__checkpoint_if_due()
+
+    def checkpoint(self):
+        self.__fh.write(_pack_log_entry(LOG_CHECKPOINT, UInt32Struct.pack(len(self.__live))))
+        self.__fh.flush()
+        os.fsync(self.__fh.fileno())
+        self.__since_checkpoint = 0
+
+    def compact(self):
+        """rewrite the log as one put for each live incident"""
+        incidents = replay_log(self.filename)
+        self.__fh.close()
+        self.__fh = None
+        write_log(self.filename, incidents.values())
+        self.__live = set(incidents)
+        self.__since_checkpoint = 0
+        self.__fh = open(self.filename, "ab")
+
+    def __len__(self):
+        return len(self.__live)
+
+    def __contains__(self, report_id):
+        return report_id in self.__live
+
+    def close(self):
+        if self.__fh is not None:
+            try:
+                if self.__since_checkpoint:
+                    self.checkpoint()
+            finally:
+                self.__fh.close()
+                self.__fh = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# dates repeat a great deal, so each distinct one is only parsed once
+_parse_date = functools.lru_cache(maxsize=4096)(datetime.date.fromisoformat)
+
+
+# the lines that start and end a narrative (trailing whitespace is allowed)
+_NARRATIVE_START_RE = re.compile(rb"^\.NARRATIVE_START\.[ \t\r]*\n", re.MULTILINE)
+_NARRATIVE_END_RE = re.compile(rb"^\.NARRATIVE_END\.[ \t\r]*\n", re.MULTILINE)
+
+
+def iter_text(filename, chunk_size=TEXT_CHUNK_SIZE, lazy_narratives=False):
+    """
+    read an .ait file one incident at a time
+
+    The file is read in chunks of chunk_size bytes and each incident is
+    parsed as soon as its .NARRATIVE_END. line has been read, so unlike
+    import_text_regex() the file is never held in memory all at once. The
+    values are validated since text files may have been edited by hand.
+
+    :param filename: an .ait file, gzip-compressed or not
+    :param chunk_size:
+    :param lazy_narratives: leave each narrative in the file until it is
+                            first used (see NarrativeSource); only for
+                            uncompressed files, others are read in full
+    :return: a generator of Incidents in file order
+    """
+    fh = open_binary(filename)
+    source = None
+    if lazy_narratives and not isinstance(fh, gzip.GzipFile):
+        try:
+            source = NarrativeSource(filename, _decode_text_narrative)
+        except:
+            fh.close()
+            raise
+    return _iter_text_incidents(fh, chunk_size, source)
+
+
+def _decode_text_narrative(data):
+    return _dedent(data.decode("utf8")).strip()
+
+
+def _iter_text_incidents(fh, chunk_size, source=None):
+    try:
+        buffer = b""
+        start = 0  # the file offset of buffer[0]
+        position = 0  # the start of the next incident in buffer
+        lino = 1  # the line number of position
+        eof = False
+        while True:
+            match = _NARRATIVE_END_RE.search(buffer, position)
+            if match is None:
+                if eof:
+                    if buffer[position:].strip():
+                        raise IncidentError("missing data on line {0}".format(lino))
+                    break
+                chunk = fh.read(chunk_size)
+                if not chunk:
+                    eof = True
+                    chunk = b"\n"  # in case the last line has no newline
+                buffer = buffer[position:] + chunk  # keep only the unfinished incident
+                start += position
+                position = 0
+                continue
+            record = buffer[position:match.start()]
+            yield _parse_text_record(record, lino, source, start + position)
+            lino += record.count(b"\n") + 1
+            position = match.end()
+    finally:
+        fh.close()
+
+
+def _parse_text_record(record, lino, source=None, offset=0):
+    # record is everything from the end of the previous incident up to (but
+    # not including) this one's .NARRATIVE_END. line, starting on line lino
+    # and at byte offset in the file
+    match = _NARRATIVE_START_RE.search(record)
+    if match is None:
+        raise IncidentError("missing data on line {0}".format(lino))
+    data = {}
+    for lino, line in enumerate(record[:match.start()].decode("utf8").split("\n"), start=lino):
+        line = line.rstrip()
+        if not line:  # skip blank lines between incidents
+            continue
+        if not data and line[0] == "[" and line[-1] == "]":
+            data["report_id"] = line[1:-1]
+        elif "=" in line:
+            key, value = line.split("=", 1)  # the value can safely include = characters
+            if key == "date":
+                data[key] = _parse_date(value)
+            elif key == "pilot_percent_hours_on_type":
+                data[key] = float(value)
+            elif key == "pilot_total_hours":
+                data[key] = int(value)
+            elif key == "midair":
+                data[key] = bool(int(value))
+            else:
+                data[key] = value
+        else:
+            raise KeyError("parsing error on line {0}".format(lino))
+    if source is not None:
+        data["narrative"] = LazyNarrative(source, offset + match.end(), len(record) - match.end())
+    else:
+        data["narrative"] = _decode_text_narrative(record[match.end():])
+    if len(data) != 9:
+        raise IncidentError("missing data on line {0}".format(lino))
+    return Incident(**data)
+
+
+def _dedent(text):
+    # the same as textwrap.dedent() except that trailing whitespace is also
+    # removed from each line; narratives written by export_text() have the
+    # same indent on every line, which is much quicker to check for directly
+    lines = [line.rstrip() for line in text.split("\n")]
+    margin = None
+    for line in lines:
+        if line:
+            margin = line[:len(line) - len(line.lstrip())]
+            break
+    if not margin:
+        return "\n".join(lines)
+    size = len(margin)
+    dedented = [line[size:] for line in lines if line.startswith(margin) or not line]
+    if len(dedented) != len(lines):  # the lines don't all share the first one's indent
+        return textwrap.dedent("\n".join(lines))
+    return "\n".join(dedented)
+
+
+def iter_xml(filename):
+    """
+    read an .aix file one incident at a time
+
+    Uses iterparse() and clears each <incident> element once it has been
+    turned into an Incident, so memory use doesn't grow with the file. The
+    values are validated since XML files may have been edited by hand.
+
+    :param filename: an .aix file, gzip-compressed or not
+    :return: a generator of Incidents in file order
+    """
+    fh = open_binary(filename)
+    try:
+        # root is needed so that finished incidents can be removed from it
+        events = iter(xml.etree.ElementTree.iterparse(fh, events=("start", "end")))
+        event, root = next(events)
+    except:
+        fh.close()
+        raise
+    return _iter_xml_incidents(fh, events, root)
+
+
+def _iter_xml_incidents(fh, events, root):
+    try:
+        for event, element in events:
+            if event != "end" or element.tag != "incident":
+                continue
+            data = {}
+            for attribute in ("report_id", "aircraft_id", "aircraft_type"):
+                data[attribute] = element.get(attribute)
+            data["date"] = datetime.datetime.strptime(element.get("date"), "%Y-%m-%d").date()
+            data["pilot_percent_hours_on_type"] = float(element.get("pilot_percent_hours_on_type"))
+            data["pilot_total_hours"] = int(element.get("pilot_total_hours"))
+            data["midair"] = bool(int(element.get("midair")))
+            data["airport"] = element.findtext("airport").strip()
+            data["narrative"] = (element.findtext("narrative") or "").strip()
+            yield Incident(**data)
+            element.clear()
+            root.clear()  # drop the (now empty) incidents already read
+    finally:
+        fh.close()
+
+
+class XmlIncidentWriter:
+    """
+    write an .aix file incrementally, one <incident> element at a time,
+    in the same form as IncidentCollection.export_xml_etree()
+
+    can also be used as a context manager
+    """
+
+    def __init__(self, filename):
+        self.__fh = open(filename, "w", encoding="utf8")
+        self.count = 0
+        try:
+            self.__fh.write("<?xml version='1.0' encoding='UTF-8'?>\n<incidents>")
+        except:
+            self.__fh.close()
+            raise
+
+    def write(self, incident):
+        # quoteattr() adds the quotes as well as escaping
+        self.__fh.write("<incident report_id={report_id} date={date} aircraft_id={aircraft_id} "
+                        "aircraft_type={aircraft_type} pilot_percent_hours_on_type={percent} "
+                        "pilot_total_hours={total} midair={midair}>"
+                        "<airport>{airport}</airport>"
+                        "<narrative>{narrative}</narrative>"
+                        "</incident>".format(
+            report_id=xml.sax.saxutils.quoteattr(incident.report_id),
+            date=xml.sax.saxutils.quoteattr(incident.date.isoformat()),
+            aircraft_id=xml.sax.saxutils.quoteattr(incident.aircraft_id),
+            aircraft_type=xml.sax.saxutils.quoteattr(incident.aircraft_type),
+            percent=xml.sax.saxutils.quoteattr(str(incident.pilot_percent_hours_on_type)),
+            total=xml.sax.saxutils.quoteattr(str(incident.pilot_total_hours)),
+            midair=xml.sax.saxutils.quoteattr(str(int(incident.midair))),
+            airport=xml.sax.saxutils.escape(incident.airport.strip()),
+            narrative=xml.sax.saxutils.escape(incident.narrative.strip())))
+        self.count += 1
+
+    def close(self):
+        if self.__fh is not None:
+            try:
+                self.__fh.write("</incidents>\n")
+            finally:
+                self.__fh.close()
+                self.__fh = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class TextIncidentWriter:
+    """
+    write an .ait file incrementally, in the same form as
+    IncidentCollection.export_text()
+
+    can also be used as a context manager
+    """
+
+    def __init__(self, filename):
+        self.__wrapper = textwrap.TextWrapper(initial_indent="    ", subsequent_indent="    ")
+        self.__fh = open(filename, "w", encoding="utf8")
+        self.count = 0
+
+    def write(self, incident):
+        self.__fh.write(format_text(incident, self.__wrapper))
+        self.count += 1
+
+    def close(self):
+        if self.__fh is not None:
+            self.__fh.close()
+            self.__fh = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class PickleIncidentWriter:
+    """
+    write an .aip file with the same writer interface as the others
+
+    A pickle holds a whole IncidentCollection, so the incidents are
+    gathered in one and only written when the writer is closed.
+    """
+
+    def __init__(self, filename, compress=False):
+        self.filename = filename
+        self.compress = compress
+        self.count = 0
+        self.__incidents = IncidentCollection()
+
+    def write(self, incident):
+        self.__incidents[incident.report_id] = incident
+        self.count += 1
+
+    def close(self):
+        if self.__incidents is None:
+            return
+        fh = (gzip.open(self.filename, "wb", PICKLE_COMPRESS_LEVEL) if self.compress
+              else open(self.filename, "wb"))
+        try:
+            pickle.dump(self.__incidents, fh, pickle.HIGHEST_PROTOCOL)
+        finally:
+            fh.close()
+            self.__incidents = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class _IncidentUnpickler(pickle.Unpickler):
+    # a pickle names the module of each class it holds, which is __main__
+    # when this file is run as a script and something else when it has been
+    # imported, so our classes are looked up by name alone
+    def find_class(self, module, name):
+        if name in ("Incident", "IncidentCollection", "_unpickle_incident", "_unpickle_collection"):
+            return globals()[name]
+        return super().find_class(module, name)
+
+
+def load_pickle(fh):
+    """unpickle an IncidentCollection written by this module, whether it was run as a script or imported"""
+    return _IncidentUnpickler(fh).load()
+
+
+class StringPool:
+    """
+    a list of distinct strings, each stored once and referred to by number
+
+    pool = StringPool()
+    pool.add("LHR") -> 0; pool.add("JFK") -> 1; pool.add("LHR") -> 0
+    pool[1] -> "JFK"
+    """
+
+    def __init__(self):
+        self.__strings = []
+        self.__ids = {}  # key: string, value: its position in self.__strings
+
+    def add(self, string):
+        id = self.__ids.get(string)
+        if id is None:
+            id = self.__ids[string] = len(self.__strings)
+            self.__strings.append(sys.intern(string))
+        return id
+
+    def __getitem__(self, id):
+        return self.__strings[id]
+
+    def __len__(self):
+        return len(self.__strings)
+
+    def __iter__(self):
+        return iter(self.__strings)
+
+
+class IncidentTable:
+    """
+    a column-oriented (struct of arrays) store of incidents
+
+    Instead of one Incident object per report, each field is kept in its
+    own column: dates as an array of ordinals, the hours in typed arrays,
+    midair as a bitmap, airports, aircraft ids and types as numbers into
+    StringPools and the narratives as one UTF-8 blob plus an array of end
+    offsets. Incidents are only created when asked for, e.g. table[row] or
+    by iterating.
+
+    Rows are kept in the order they were added; the export methods write
+    them in that order and import methods append.
+    """
+
+    def __init__(self, incidents=None):
+        self.report_ids = []
+        self.dates = array.array("I")  # date ordinals
+        self.pilot_percent_hours_on_type = array.array("d")
+        self.pilot_total_hours = array.array("i")
+        self.midair_bitmap = bytearray()  # bit (row % 8) of byte (row // 8)
+        self.airports = StringPool()
+        self.airport_ids = array.array("I")
+        self.aircraft_ids = StringPool()
+        self.aircraft_id_ids = array.array("I")
+        self.aircraft_types = StringPool()
+        self.aircraft_type_ids = array.array("I")
+        self.__narratives = bytearray()  # every narrative, UTF-8 encoded, end to end
+        self.__narrative_ends = array.array("Q")  # row's narrative is [ends[row - 1]:ends[row]]
+        self.__rows = None  # key: report_id, value: row; built on first use
+        if incidents is not None:
+            self.extend(incidents)
+
+    def append_fields(self, report_id, date, airport, aircraft_id, aircraft_type, pilot_percent_hours_on_type,
+                      pilot_total_hours, midair, narrative=""):
+        """add a row from field values, taking the same arguments as Incident()"""
+        row = len(self.report_ids)
+        self.report_ids.append(report_id)
+        self.dates.append(date.toordinal())
+        self.pilot_percent_hours_on_type.append(pilot_percent_hours_on_type)
+        self.pilot_total_hours.append(pilot_total_hours)
+        if row % 8 == 0:
+            self.midair_bitmap.append(0)
+        if midair:
+            self.midair_bitmap[row >> 3] |= 1 << (row & 7)
+        self.airport_ids.append(self.airports.add(airport))
+        self.aircraft_id_ids.append(self.aircraft_ids.add(aircraft_id))
+        self.aircraft_type_ids.append(self.aircraft_types.add(aircraft_type))
+        self.__narratives.extend(narrative.encode("utf8"))
+        self.__narrative_ends.append(len(self.__narratives))
+        if self.__rows is not None:
+            self.__rows[report_id] = row
+
+    def append(self, incident):
+        self.append_fields(*(getattr(incident, name) for name in FIELD_NAMES))
+
+    def extend(self, incidents):
+        for incident in incidents:
+            self.append(incident)
+
+    def clear(self):
+        self.__init__()
+
+    def __len__(self):
+        return len(self.report_ids)
+
+    def midair(self, row):
+        return bool(self.midair_bitmap[row >> 3] & (1 << (row & 7)))
+
+    def narrative(self, row):
+        start = self.__narrative_ends[row - 1] if row > 0 else 0
+        return self.__narratives[start:self.__narrative_ends[row]].decode("utf8")
+
+    def fields(self, row):
+        """the given row's field values in FIELD_NAMES order"""
+        return (self.report_ids[row], datetime.date.fromordinal(self.dates[row]),
+                self.airports[self.airport_ids[row]], self.aircraft_ids[self.aircraft_id_ids[row]],
+                self.aircraft_types[self.aircraft_type_ids[row]], self.pilot_percent_hours_on_type[row],
+                self.pilot_total_hours[row], self.midair(row), self.narrative(row))
+
+    def __getitem__(self, row):
+        if row < 0:
+            row += len(self)
+        if not 0 <= row < len(self):
+            raise IndexError("IncidentTable index out of range")
+        return Incident.from_trusted_fields(*self.fields(row))
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield Incident.from_trusted_fields(*self.fields(row))
+
+    def row(self, report_id):
+        """the row holding the given report, or None"""
+        if self.__rows is None:
+            self.__rows = {report_id: row for row, report_id in enumerate(self.report_ids)}
+        return self.__rows.get(report_id)
+
+    def to_collection(self):
+        incidents = IncidentCollection()
+        for incident in self:
+            incidents[incident.report_id] = incident
+        return incidents
+
+    def export_binary(self, filename, compress=False):
+        writer = None
+        try:
+            writer = BinaryIncidentWriter(filename, compress)
+            for incident in self:
+                writer.write(incident)
+            return True
+        except EnvironmentError as err:
+            print("{0}: export error: {1}".format(os.path.basename(sys.argv[0]), err))
+            return False
+        finally:
+            if writer is not None:
+                writer.close()
+
+    def import_binary(self, filename):
+        try:
+            records = iter_binary_fields(filename)
+            self.clear()
+            for fields in records:
+                self.append_fields(*fields)
+            return True
+        except(EnvironmentError, ValueError, IndexError, IncidentError) as err:
+            print("{0}: import error: {1}".format(os.path.basename(sys.argv[0]), err))
+            return False
+
+    # the pickle format holds a whole IncidentCollection, so these go through one
+
+    def export_pickle(self, filename, compress=False):
+        return self.to_collection().export_pickle(filename, compress)
+
+    def import_pickle(self, filename):
+        incidents = IncidentCollection()
+        if not incidents.import_pickle(filename):
+            return False
+        self.clear()
+        self.extend(incidents.values())
+        return True
+
+    def export_text(self, filename):
+        wrapper = textwrap.TextWrapper(initial_indent="    ", subsequent_indent="    ")
+        fh = None
+        try:
+            fh = open(filename, "w", encoding="utf8")
+            for incident in self:
+                fh.write(format_text(incident, wrapper))
+            return True
+        except EnvironmentError as err:
+            print("{0}: export error: {1}".format(os.path.basename(sys.argv[0]), err))
+            return False
+        finally:
+            if fh is not None:
+                fh.close()
+
+    def import_text(self, filename):
+        try:
+            incidents = iter_text(filename)
+            self.clear()
+            self.extend(incidents)
+            return True
+        except (EnvironmentError, ValueError, KeyError, IncidentError) as err:
+            print("{0}: import error: {1}".format(os.path.basename(sys.argv[0]), err))
+            return False
+
+
+class SecondaryIndexes:
+    """
+    hash indexes of report_ids by airport and by aircraft type, and a sorted
+    index by date, for IncidentCollection's queries
+
+    The indexed values are recorded for each report, so an incident can be
+    removed correctly even if it was changed after it was added; but a
+    change is only reflected in the indexes once the incident is stored
+    again, e.g. incidents[incident.report_id] = incident.
+    """
+
+    def __init__(self, items=()):
+        """
+        :param items: (report_id, incident) pairs to index; the date index
+                      is sorted once, rather than inserted into for each
+        """
+        self.__airports = collections.defaultdict(set)  # key: airport, value: set of report_ids
+        self.__aircraft_types = collections.defaultdict(set)
+        self.__indexed = {}  # key: report_id, value: (airport, aircraft_type, ordinal)
+        # sorted (date ordinal, report_id) pairs
+        self.__dates = sorted(self.__record(report_id, incident) for report_id, incident in items)
+
+    def __record(self, report_id, incident):
+        # index the incident by airport and aircraft type and return its date index entry
+        ordinal = incident.date.toordinal()
+        self.__indexed[report_id] = (incident.airport, incident.aircraft_type, ordinal)
+        self.__airports[incident.airport].add(report_id)
+        self.__aircraft_types[incident.aircraft_type].add(report_id)
+        return ordinal, report_id
+
+    def add(self, report_id, incident):
+        bisect.insort(self.__dates, self.__record(report_id, incident))
+
+    def remove(self, report_id):
+        airport, aircraft_type, ordinal = self.__indexed.pop(report_id)
+        self.__discard(self.__airports, airport, report_id)
+        self.__discard(self.__aircraft_types, aircraft_type, report_id)
+        index = bisect.bisect_left(self.__dates, (ordinal, report_id))
+        del self.__dates[index]
+
+    @staticmethod
+    def __discard(index, key, report_id):
+        report_ids = index[key]
+        report_ids.discard(report_id)
+        if not report_ids:
+            del index[key]
+
+    def by_airport(self, airport):
+        return sorted(self.__airports.get(airport, ()))
+
+    def by_aircraft_type(self, aircraft_type):
+        return sorted(self.__aircraft_types.get(aircraft_type, ()))
+
+    def between(self, first_date, last_date):
+        left = bisect.bisect_left(self.__dates, (first_date.toordinal(),))
+        right = bisect.bisect_left(self.__dates, (last_date.toordinal() + 1,))
+        return [report_id for ordinal, report_id in self.__dates[left:right]]
+
+
+class NarrativeIndex:
+    """
+    an inverted index of the words in incident narratives
+
+    Each word (lowercased) maps to the report_ids whose narratives contain
+    it and the word's positions in each, so search() can answer AND, OR and
+    phrase queries without reading any narratives. The index can be saved
+    beside an .aib file and loaded on its own.
+    """
+
+    WORD_RE = re.compile(r"\w+")
+
+    def __init__(self):
+        # key: word, value: dict of report_id -> array of word positions
+        self.__postings = collections.defaultdict(dict)
+        self.__words = {}  # key: report_id, value: the set of its words, for remove()
+
+    @classmethod
+    def tokenize(cls, text):
+        return cls.WORD_RE.findall(text.lower())
+
+    def add(self, report_id, narrative):
+        if report_id in self.__words:
+            self.remove(report_id)
+        positions = collections.defaultdict(lambda: array.array("I"))
+        for position, word in enumerate(self.tokenize(narrative)):
+            positions[word].append(position)
+        for word, word_positions in positions.items():
+            self.__postings[word][report_id] = word_positions
+        self.__words[report_id] = set(positions)
+
+    def remove(self, report_id):
+        for word in self.__words.pop(report_id, ()):
+            postings = self.__postings[word]
+            del postings[report_id]
+            if not postings:
+                del self.__postings[word]
+
+    def __len__(self):
+        return len(self.__words)
+
+    def all_of(self, words):
+        """the set of report_ids whose narratives contain every one of the words"""
+        postings = sorted((self.__postings.get(word, {}) for word in words), key=len)
+        if not postings:
+            return set()
+        report_ids = set(postings[0])
+        for other in postings[1:]:
+            report_ids.intersection_update(other)
+        return report_ids
+
+    def any_of(self, words):
+        """the set of report_ids whose narratives contain at least one of the words"""
+        report_ids = set()
+        for word in words:
+            report_ids.update(self.__postings.get(word, ()))
+        return report_ids
+
+    def phrase(self, words):
+        """the set of report_ids whose narratives contain the words consecutively"""
+        report_ids = set()
+        for report_id in self.all_of(words):
+            starts = set(self.__postings[words[0]][report_id])
+            for offset, word in enumerate(words[1:], start=1):
+                starts.intersection_update(position - offset
+                                           for position in self.__postings[word][report_id])
+            if starts:
+                report_ids.add(report_id)
+        return report_ids
+
+    def search(self, query):
+        """
+        the sorted report_ids matching the query
 
-    @property.setter
-    def pilot_total_hours(self, pilot_total_hours):
-        assert pilot_total_hours > 0, "invalid number of hours"
-        self.__pilot_total_hours = pilot_total_hours
+        Words are ANDed together, "OR" separates alternatives and double
+        quotes mark a phrase, e.g. 'bird strike OR "engine failure" fire'
+        finds narratives with both bird and strike, or with the phrase
+        engine failure and the word fire.
+        """
+        report_ids = set()
+        for alternative in re.split(r"\s+OR\s+", query):
+            matches = None
+            for phrase, word in re.findall(r'"([^"]*)"|(\S+)', alternative):
+                words = self.tokenize(phrase if phrase else word)
+                if not words:
+                    continue
+                found = self.phrase(words) if phrase else self.all_of(words)
+                matches = found if matches is None else matches & found
+            if matches:
+                report_ids |= matches
+        return sorted(report_ids)
 
-    @property
-    def midair(self):
-        return self.__midair
+    def save(self, filename):
+        """
+        write the index beside the given .aib file (filename + NARRATIVE_INDEX_SUFFIX)
 
-    @property.setter
-    def midair(self, midair):
-        assert isinstance(midair, bool), "invalid midair value"
-        self.__midair = midair
+        The report_ids are written once in a table and the postings refer to
+        them by number.
+        """
+        numbers = {report_id: number for number, report_id in enumerate(self.__words)}
+        fh = open(filename + NARRATIVE_INDEX_SUFFIX, "wb")
+        try:
+            fh.write(NARRATIVE_INDEX_MAGIC)
+            fh.write(UInt32Struct.pack(len(numbers)))
+            for report_id in numbers:
+                fh.write(pack_string(report_id))
+            for word, postings in self.__postings.items():
+                fh.write(pack_string(word))
+                fh.write(UInt32Struct.pack(len(postings)))
+                for report_id, positions in postings.items():
+                    fh.write(UInt32Struct.pack(numbers[report_id]))
+                    fh.write(UInt32Struct.pack(len(positions)))
+                    if sys.byteorder != "little":  # written little-endian, like the structs
+                        positions = array.array("I", positions)
+                        positions.byteswap()
+                    fh.write(positions.tobytes())
+        finally:
+            fh.close()
 
-    @property
-    def narrative(self):
-        return self.__narrative
+    @classmethod
+    def load(cls, filename):
+        """
+        read the index saved beside the given .aib file
 
-    @property.setter
-    def narrative(self, narrative):
-        self.__narrative = narrative
+        :param filename: the .aib file (not the index file itself)
+        :return: a NarrativeIndex, or None if there is no up-to-date index
+        """
+        index_filename = filename + NARRATIVE_INDEX_SUFFIX
+        if (not os.path.exists(index_filename) or
+                os.path.getmtime(index_filename) < os.path.getmtime(filename)):
+            return None
 
-    @property
-    def approximate_hours_on_type(self):
-        return int(self.__pilot_total_hours * self.__pilot_percent_hours_on_type / 100)
+        def read_uint32():
+            data = fh.read(UInt32Struct.size)
+            if len(data) != UInt32Struct.size:
+                raise ValueError("missing or corrupt narrative index")
+            return UInt32Struct.unpack(data)[0]
+
+        index = cls()
+        fh = open(index_filename, "rb")
+        try:
+            if fh.read(len(NARRATIVE_INDEX_MAGIC)) != NARRATIVE_INDEX_MAGIC:
+                raise ValueError("invalid narrative index file format")
+            report_ids = [unpack_string(fh) for _ in range(read_uint32())]
+            for report_id in report_ids:
+                index.__words[report_id] = set()
+            while True:
+                word = unpack_string(fh, False)
+                if word is None:
+                    break
+                postings = index.__postings[word]
+                for _ in range(read_uint32()):
+                    report_id = report_ids[read_uint32()]
+                    positions = array.array("I")
+                    size = read_uint32() * UInt32Struct.size
+                    data = fh.read(size)
+                    if len(data) != size:
+                        raise ValueError("missing or corrupt narrative index")
+                    positions.frombytes(data)
+                    if sys.byteorder != "little":
+                        positions.byteswap()
+                    postings[report_id] = positions
+                    index.__words[report_id].add(word)
+        finally:
+            fh.close()
+        return index
 
 
 class IncidentCollection(dict):  # extends dict  # no need to reimplement the initializer
@@ -135,11 +2064,178 @@ class IncidentCollection(dict):  # extends dict  # no need to reimplement the in
         for report_id in self.keys():  # call __iter__K
             yield (report_id, self[report_id])
 
+    # the report_ids in sorted order, or None if they must be sorted again;
+    # only adding or removing a report_id invalidates it, so repeated
+    # iterations and exports sort just once
+    __sorted_keys = None
+
     def __iter__(self):
-        for report_id in sorted(super().keys()):  # sorted
-            yield report_id
+        if self.__sorted_keys is None:
+            self.__sorted_keys = sorted(super().keys())  # sorted
+        return iter(self.__sorted_keys)
+
+    keys = __iter__
+
+    # the SecondaryIndexes used by by_airport(), by_aircraft_type() and
+    # between(), and the NarrativeIndex used by search_narratives(); each is
+    # None until it is first needed
+    __indexes = None
+    __narrative_index = None
+
+    # every dict method that can add or remove a key must drop the cached
+    # order, and every one that can add, replace or remove an incident must
+    # keep the secondary indexes up to date
+
+    def __index(self, report_id, incident):
+        if self.__indexes is not None:
+            self.__indexes.add(report_id, incident)
+        if self.__narrative_index is not None:
+            self.__narrative_index.add(report_id, incident.narrative)
+
+    def __unindex(self, report_id):
+        if self.__indexes is not None:
+            self.__indexes.remove(report_id)
+        if self.__narrative_index is not None:
+            self.__narrative_index.remove(report_id)
+
+    def __setitem__(self, report_id, incident):
+        if report_id not in self:
+            self.__sorted_keys = None
+        else:
+            self.__unindex(report_id)
+        super().__setitem__(report_id, incident)
+        self.__index(report_id, incident)
+
+    def __delitem__(self, report_id):
+        super().__delitem__(report_id)
+        self.__sorted_keys = None
+        self.__unindex(report_id)
+
+    def setdefault(self, report_id, incident=None):
+        if report_id not in self:
+            self[report_id] = incident
+        return self[report_id]
+
+    def update(self, *args, **kwargs):
+        if self.__indexes is None and self.__narrative_index is None:
+            super().update(*args, **kwargs)
+            self.__sorted_keys = None
+        else:
+            for report_id, incident in dict(*args, **kwargs).items():
+                self[report_id] = incident
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def pop(self, report_id, *args):
+        if report_id in self:
+            incident = self[report_id]
+            del self[report_id]
+            return incident
+        return super().pop(report_id, *args)  # raises KeyError or returns the default
+
+    def popitem(self):
+        report_id, incident = super().popitem()
+        self.__sorted_keys = None
+        self.__unindex(report_id)
+        return report_id, incident
+
+    def clear(self):
+        for source in self.__narrative_sources():
+            source.close()
+        super().clear()
+        self.__sorted_keys = None
+        self.__indexes = None
+        self.__narrative_index = None
+
+    def __getstate__(self):
+        # the cached order and the indexes are rebuilt on demand, so they
+        # aren't pickled
+        state = self.__dict__.copy()
+        state.pop("_IncidentCollection__sorted_keys", None)
+        state.pop("_IncidentCollection__indexes", None)
+        state.pop("_IncidentCollection__narrative_index", None)
+        return state or None
 
-    keys = __iter__()
+    def __reduce__(self):
+        # pickled column by column: the numbers as arrays (written as raw
+        # bytes), the airports, aircraft ids and aircraft types as numbers
+        # into one list of distinct strings, so each incident costs little
+        # more than its report_id and narrative
+        incidents = list(super().values())
+        strings = StringPool()
+        airport_ids = array.array("I", [strings.add(incident.airport) for incident in incidents])
+        aircraft_id_ids = array.array("I", [strings.add(incident.aircraft_id) for incident in incidents])
+        aircraft_type_ids = array.array("I", [strings.add(incident.aircraft_type) for incident in incidents])
+        columns = (list(super().keys()),
+                   [incident.report_id for incident in incidents],
+                   _pickle_column("I", [incident.date.toordinal() for incident in incidents]),
+                   list(strings), airport_ids, aircraft_id_ids, aircraft_type_ids,
+                   _pickle_column("d", [incident.pilot_percent_hours_on_type for incident in incidents]),
+                   _pickle_column("i", [incident.pilot_total_hours for incident in incidents]),
+                   bytes(incident.midair for incident in incidents),
+                   [incident.narrative for incident in incidents])
+        state = self.__getstate__()
+        if state is None:
+            return _unpickle_collection, columns
+        return _unpickle_collection, columns, state
+
+    def __copy__(self):
+        # a shallow copy shares the Incidents, unlike the pickled form
+        return IncidentCollection(self)
+
+    def __get_indexes(self):
+        if self.__indexes is None:
+            self.__indexes = SecondaryIndexes(super().items())
+        return self.__indexes
+
+    def by_airport(self, airport):
+        """the incidents at the given airport, in report_id order"""
+        return [self[report_id] for report_id in self.__get_indexes().by_airport(airport)]
+
+    def by_aircraft_type(self, aircraft_type):
+        """the incidents involving the given type of aircraft, in report_id order"""
+        return [self[report_id] for report_id in self.__get_indexes().by_aircraft_type(aircraft_type)]
+
+    def between(self, first_date, last_date):
+        """the incidents dated first_date..last_date inclusive, in date order"""
+        return [self[report_id] for report_id in self.__get_indexes().between(first_date, last_date)]
+
+    def load_narratives(self):
+        """
+        read every lazy narrative (see NarrativeSource) into its incident, so
+        that none depend on the file they were imported from any more
+        """
+        for incident in super().values():
+            incident.narrative = incident.narrative
+
+    def __narrative_sources(self):
+        return {incident.narrative_source for incident in super().values()} - {None}
+
+    def __release(self, filename):
+        # read the lazy narratives that come from filename, which is about
+        # to be written over, and close its source
+        sources = {source for source in self.__narrative_sources() if _same_file(source.filename, filename)}
+        if sources:
+            for incident in super().values():
+                if incident.narrative_source in sources:
+                    incident.narrative = incident.narrative
+            for source in sources:
+                source.close()
+
+    def narrative_index(self):
+        """the NarrativeIndex of this collection, built the first time it is asked for"""
+        if self.__narrative_index is None:
+            index = NarrativeIndex()
+            for report_id, incident in super().items():
+                index.add(report_id, incident.narrative)
+            self.__narrative_index = index
+        return self.__narrative_index
+
+    def search_narratives(self, query):
+        """the incidents whose narratives match the query (see NarrativeIndex.search()), in report_id order"""
+        return [self[report_id] for report_id in self.narrative_index().search(query)]
 
     def export_pickle(self, filename, compress=False):
         """
@@ -154,14 +2250,15 @@ class IncidentCollection(dict):  # extends dict  # no need to reimplement the in
         # needing to intervene
         fh = None
         try:
+            self.__release(filename)
             if compress:
-                fh = gzip.open(filename, "wb")  # gzip compression, write binary
+                fh = gzip.open(filename, "wb", PICKLE_COMPRESS_LEVEL)  # gzip compression, write binary
             else:
                 fh = open(filename, "wb")  # write binary
             pickle.dump(self, fh,
                         pickle.HIGHEST_PROTOCOL)  # write file with pickle, HIGHEST_PROTOCOL, a compact binary pickle format
             return True
-        except(EnvironmentError, pickle.PickleError) as err:
+        except(EnvironmentError, ValueError, pickle.PickleError) as err:
             print("{0}: export error: {1}".format(os.path.basename(sys.argv[0]), err))
         finally:
             if fh is not None:
@@ -191,7 +2288,7 @@ class IncidentCollection(dict):  # extends dict  # no need to reimplement the in
             self.clear()
             # populate the dictionary with all the incidents from the IncidentCollection dictionary
             # loaded from the pickle
-            self.update(pickle.load(fh))
+            self.update(load_pickle(fh))
             return True
         except (EnvironmentError, pickle.UnpicklingError) as err:
             print("{0}: import error: {1}".format(os.path.basename(sys.argv[0]), err))
@@ -200,128 +2297,205 @@ class IncidentCollection(dict):  # extends dict  # no need to reimplement the in
             if fh is not None:
                 fh.close()
 
-    def export_binary(self, filename, compress=False):
-        def pack_string(string):  # inner function
-            data = string.encode("utf8")
-            # to hold a struct format based on the string's length.
-            # h: 16-bit signed integer, H: 16-bit unsigned integer
-            # <: little-endian
-            # >: big-endian
-            format = "<H{0}s".format(len(data))
-            return struct.pack(format, len(data), data)
+    def export_binary(self, filename, compress=False, index=False, codec=None, narrative_index=False,
+                      string_table=False):
+        """
+        write the IncidentsCollections to an .aib file
 
-        fh = None
+        :param filename:
+        :param compress: gzip or not
+        :param index: also write a report_id/date index sidecar for lookup()
+        :param codec: if given (see BLOCK_CODECS), write a version 2 file of
+                      independently compressed blocks instead; compress and
+                      index don't apply to these
+        :param narrative_index: also save the NarrativeIndex beside the file
+        :param string_table: write a version 3 file, which holds each distinct
+                             airport, aircraft_id and aircraft_type only once;
+                             these can't be indexed or written in blocks
+        :return: success or not
+        """
+        writer = None
         try:
-            if compress:
-                fh = gzip.open(filename, "wb")
+            self.__release(filename)
+            if codec is not None:
+                if compress or index or string_table:
+                    raise ValueError("block files are not gzipped, indexed or string tabled")
+                writer = BlockIncidentWriter(filename, codec)
+            elif string_table:
+                if index:
+                    raise ValueError("string table files are not indexed")
+                writer = StringTableIncidentWriter(filename, compress)
             else:
-                fh = open(filename, "wb")
-            fh.write(MAGIC)
-            fh.write(FORMAT_VERSION)
+                writer = BinaryIncidentWriter(filename, compress, index)
             for incident in self.values():
-                data = bytearray()
-                data.extend(pack_string(incident.report_id))
-                data.extend(pack_string(incident.airport))
-                data.extend(pack_string(incident.aircraft_id))
-                data.extend(pack_string(incident.aircraft_type))
-                data.extend(pack_string(incident.narrative.strip()))
-                data.extend(NumbersStruct.pack(
-                    incident.date.toordinal(),
-                    incident.pilot_percent_hours_on_type,
-                    incident.pilot_total_hours,
-                    incident.midair
-                ))
-                fh.write(data)
+                writer.write(incident)
+            writer.close()  # so that the narrative index is newer than the file
+            if narrative_index:
+                self.narrative_index().save(filename)
             return True
-        except EnvironmentError as err:
+        except (EnvironmentError, ValueError) as err:
             print("{0}: export error: {1}".format(os.path.basename(sys.argv[0]), err))
             return False
         finally:
-            if fh is not None:
-                fh.close()
+            if writer is not None:
+                writer.close()
 
-    def import_binary(self, filename):
-        def unpack_string(fh, eof_is_error=True):
-            unit16 = struct.Struct("<H")  # little-endian, 16-bit unsigned
-            length_data = fh.read(unit16.size)
-            if not length_data:  # null
-                if eof_is_error:
-                    raise ValueError("missing or corrupt string size")
-                return None
-            length = unit16.unpack(length_data)[0]
-            if length == 0:
-                return ""
-            data = fh.read(length)
-            if not data or len(data) != length:
-                raise ValueError("missing or corrupt string")
-            format = "<{0}s".format(length)
-            return struct.unpack(format, data)[0].decode("utf8")
+    def import_binary(self, filename, max_workers=None, lazy_narratives=False):
+        """
+        read an .aib file of any version
 
-        fh = None
+        :param filename:
+        :param max_workers: for version 2 files, decompress blocks in this
+                            many threads
+        :param lazy_narratives: read each narrative only when it is first
+                                used (see iter_binary())
+        :return: success or not
+        """
         try:
-            fh = open(filename, "rb")  # the file may or may not compressed
-            magic = fh.read(len(GZIP_MAGIC))  # read the first four bytes
-            if magic == GZIP_MAGIC:
-                fh.close()
-                fh = gzip.open(filename, "rb")
-            else:
-                fh.seek(0)
-            magic = fh.read(len(MAGIC))
-            if magic != MAGIC:  # isn't a binary aircraft incident data file
-                raise ValueError("invalid .aib file format")
-            version = fh.read(len(FORMAT_VERSION))  # read 2 bytes version number
-            if version > FORMAT_VERSION:  # the version is a later one
-                raise ValueError("unrecognized .aib file version")
+            # the header is checked before we clear the dict, so a bad file
+            # leaves the collection untouched
+            incidents = iter_binary(filename, max_workers=max_workers, lazy_narratives=lazy_narratives)
             self.clear()  # empty the dict
+            for incident in incidents:
+                self[incident.report_id] = incident
+            return True
+        except(EnvironmentError, ValueError, IndexError, IncidentError) as err:
+            print("{0}: import error: {1}".format(os.path.basename(sys.argv[0]), err))
+            return False
 
-            while True:
-                report_id = unpack_string(fh, False)
-                if report_id is None:
-                    break
-                data = {}
-                data["report_id"] = report_id  # dict add element
-                for name in ("airport", "aircraft_id", "aircraft_type", "narrative"):  # set
-                    data[name] = unpack_string(fh)
-                other_data = fh.read(NumbersStruct.size)
-                # NumbersStruct = struct.Struct("<Idi?")
-                numbers = NumbersStruct.unpack(other_data)
-                data["date"] = datetime.date.fromordinal(numbers[0])
-                data["pilot_percent_hours_on_type"] = numbers[1]
-                data["pilot_total_hours"] = numbers[2]
-                data["midair"] = numbers[3]
-                incident = Incident(**data)  # mapping unpacking
+    def import_binary_mmap(self, filename):
+        """
+        read an .aib file like import_binary(), but memory-mapped
+
+        much faster for large uncompressed files; compressed files are read
+        the ordinary way
+
+        :param filename:
+        :return: success or not
+        """
+        try:
+            incidents = iter_binary_mmap(filename)
+            self.clear()
+            for incident in incidents:
+                self[incident.report_id] = incident
+            return True
+        except(EnvironmentError, ValueError, IndexError, IncidentError) as err:
+            print("{0}: import error: {1}".format(os.path.basename(sys.argv[0]), err))
+            return False
+
+    @staticmethod
+    def lookup(filename, report_id):
+        """
+        read a single incident from an .aib file
+
+        With an index sidecar this bisects the sidecar and seeks straight to
+        the record (cheap for uncompressed files; gzip files have to inflate
+        up to it); without one the file is scanned.
+
+        :param filename:
+        :param report_id:
+        :return: the Incident, or None if there is no such report
+        """
+        index = IncidentIndex.load(filename)
+        if index is None:
+            for incident in iter_binary(filename):
+                if incident.report_id == report_id:
+                    return incident
+            return None
+        with index:
+            offset = index.offset(report_id)
+        if offset is None:
+            return None
+        fh = open_binary(filename)
+        try:
+            read_binary_header(fh)
+            fh.seek(offset)
+            return Incident.from_trusted_fields(*unpack_record(fh))
+        finally:
+            fh.close()
+
+    def import_binary_between(self, filename, first_date, last_date):
+        """
+        read only the incidents dated first_date..last_date (inclusive)
+
+        uses the index sidecar to seek to the matching records if there is
+        one; otherwise the whole file is scanned, except that blocks of
+        version 2 files outside the range are skipped unread
+
+        :param filename:
+        :param first_date: datetime.date
+        :param last_date: datetime.date
+        :return: success or not
+        """
+        fh = None
+        try:
+            index = IncidentIndex.load(filename)
+            if index is None:
+                incidents = iter_binary(filename, first_date, last_date)
+                self.clear()
+                for incident in incidents:
+                    self[incident.report_id] = incident
+                return True
+            with index:
+                offsets = index.offsets_between(first_date, last_date)
+            fh = open_binary(filename)
+            read_binary_header(fh)
+            self.clear()
+            for offset in offsets:
+                fh.seek(offset)
+                incident = Incident.from_trusted_fields(*unpack_record(fh))
                 self[incident.report_id] = incident
             return True
         except(EnvironmentError, ValueError, IndexError, IncidentError) as err:
             print("{0}: import error: {1}".format(os.path.basename(sys.argv[0]), err))
+            return False
         finally:
             if fh is not None:
                 fh.close()
 
+    def export_log(self, filename):
+        """
+        write the IncidentCollection as a compacted incident log (see IncidentLog)
+
+        :param filename:
+        :return: success or not
+        """
+        try:
+            self.__release(filename)
+            write_log(filename, self.values())
+            return True
+        except (EnvironmentError, ValueError) as err:
+            print("{0}: export error: {1}".format(os.path.basename(sys.argv[0]), err))
+            return False
+
+    def import_log(self, filename):
+        """
+        replay an incident log (see IncidentLog)
+
+        :param filename:
+        :return: success or not
+        """
+        try:
+            incidents = replay_log(filename)
+            self.clear()
+            self.update(incidents)
+            return True
+        except(EnvironmentError, ValueError, IndexError, IncidentError, struct.error) as err:
+            print("{0}: import error: {1}".format(os.path.basename(sys.argv[0]), err))
+            return False
+
     def export_text(self, filename):
         wrapper = textwrap.TextWrapper(initial_indent="    ", subsequent_indent="    ")  # textWrap.TextWrap object
         fh = None
         try:
+            self.__release(filename)
             fh = open(filename, "w", encoding="utf8")
             for incident in self.values():
-                narrative = "\n".join(wrapper.wrap(incident.narrative.strip()))
-                fh.writable("[{0.report_id}]\n"
-                            # !s to force string form, !r to force representational form,
-                            # !a to force representational form but only using ascii characters
-                            "date={0.date!s}\n"
-                            "aircraft_id={0.aircraft_id}\n"
-                            "airport={airport}\n"
-                            "pilot_percent_hours_on_type={0.pilot_percent_hours_on_type}\n"
-                            "pilot_total_hours={0.pilot_total_hours}\n"
-                            "midair={0.midair:d}\n"  # bool as integer
-                            ".NARRATIVE_START.\n"
-                            "{narrative}\n"
-                            ".NARRATIVE_END.\n"
-                            "\n".format(incident, airport=incident.airport.strip(), narrative=narrative)
-                            )
-                return True
-        except EnvironmentError as err:
+                fh.write(format_text(incident, wrapper))
+            return True
+        except (EnvironmentError, ValueError) as err:
             print("{0}: export error: {1}".format(os.path.basename(sys.argv[0]), err))
+            return False
         finally:
             if fh is not None:
                 fh.close()
@@ -387,6 +2561,24 @@ class IncidentCollection(dict):  # extends dict  # no need to reimplement the in
             if fh is not None:
                 fh.close()
 
+    def import_text_stream(self, filename, lazy_narratives=False):
+        """
+        read an .ait file incrementally (see iter_text())
+
+        :param filename:
+        :param lazy_narratives: read each narrative only when it is first used
+        :return: success or not
+        """
+        try:
+            incidents = iter_text(filename, lazy_narratives=lazy_narratives)
+            self.clear()
+            for incident in incidents:
+                self[incident.report_id] = incident
+            return True
+        except (EnvironmentError, ValueError, KeyError, IncidentError) as err:
+            print("{0}: import error: {1}".format(os.path.basename(sys.argv[0]), err))
+            return False
+
     def import_text_regex(self, filename):
         incident_re = re.compile(
             # raw string
@@ -406,7 +2598,7 @@ class IncidentCollection(dict):  # extends dict  # no need to reimplement the in
 
         fh = None
         try:
-            fh = open(filename, "r", encoding="ut8")
+            fh = open(filename, "r", encoding="utf8")
             self.clear()
             for incident_match in incident_re.finditer(fh.read()):
                 data = {}
@@ -415,14 +2607,14 @@ class IncidentCollection(dict):  # extends dict  # no need to reimplement the in
                 keyvalues = incident_match.group("keyvalues")
                 for match in key_value_re.finditer(keyvalues):
                     data[match.group("key")] = match.group("value")
-                data["date"] = datetime.datetime.strftime(data["date"], "%Y-%m-%d").date()
+                data["date"] = datetime.datetime.strptime(data["date"], "%Y-%m-%d").date()
                 data["pilot_percent_hours_on_type"] = (float(data["pilot_percent_hours_on_type"]))
                 data["pilot_total_hours"] = int(data["pilot_total_hours"])
-                data["midair"] = bool(data["midair"])
+                data["midair"] = bool(int(data["midair"]))
                 if len(data) != 9:
                     raise IncidentError("missing data")
                 incident = Incident(**data)
-                self[incident.report_id, incident]
+                self[incident.report_id] = incident
             return True
         except (EnvironmentError, ValueError, KeyError, IncidentError) as err:
             print("{0}: import error: {1}".format(os.path.basename(sys.argv[0]), err))
@@ -437,7 +2629,7 @@ class IncidentCollection(dict):  # extends dict  # no need to reimplement the in
         root = xml.etree.ElementTree.Element("incidents")
         for incident in self.values():
             element = xml.etree.ElementTree.Element("incident",report_id=incident.report_id,
-                                                    date=incident.isoformat(),
+                                                    date=incident.date.isoformat(),
                                                     aircraft_id=incident.aircraft_id,
                                                     aircraft_type=incident.aircraft_type,
                                                     pilot_percent_hours_on_type=str(incident.pilot_percent_hours_on_type),
@@ -451,8 +2643,486 @@ class IncidentCollection(dict):  # extends dict  # no need to reimplement the in
         tree = xml.etree.ElementTree.ElementTree(root)
 
         try:
+            self.__release(filename)
             tree.write(filename,'UTF-8') # utf8 not accepted
-        except EnvironmentError as err:
+        except (EnvironmentError, ValueError) as err:
             print("{0}: import error: {1}".format(os.path.basename(sys.argv[0]),err))
             return False
-        return True
\ No newline at end of file
+        return True
+
+    def export_xml_stream(self, filename):
+        """
+        write the same XML as export_xml_etree() but one incident at a
+        time, without building an ElementTree of the whole collection
+
+        :param filename:
+        :return: success or not
+        """
+        writer = None
+        try:
+            self.__release(filename)
+            writer = XmlIncidentWriter(filename)
+            for incident in self.values():
+                writer.write(incident)
+            return True
+        except (EnvironmentError, ValueError) as err:
+            print("{0}: export error: {1}".format(os.path.basename(sys.argv[0]), err))
+            return False
+        finally:
+            if writer is not None:
+                writer.close()
+
+    def export_many(self, targets, threaded=None):
+        """
+        write the IncidentCollection in several formats in one pass (see fan_out())
+
+        :param targets: (filename, format) or (filename, format, compress)
+                        tuples, where format is one of FORMAT_EXTENSIONS' keys
+        :param threaded: passed on to fan_out()
+        :return: success or not
+        """
+        writers = []
+        try:
+            for target in targets:
+                self.__release(target[0])
+                writers.append(open_writer(*target))
+        except (EnvironmentError, ValueError) as err:
+            for writer in writers:
+                writer.close()
+            print("{0}: export error: {1}".format(os.path.basename(sys.argv[0]), err))
+            return False
+        try:
+            fan_out(self.values(), writers, threaded=threaded)
+            return True
+        except (EnvironmentError, ValueError) as err:
+            print("{0}: export error: {1}".format(os.path.basename(sys.argv[0]), err))
+            return False
+
+    def import_xml_iterparse(self, filename):
+        """
+        read an .aix file incrementally (see iter_xml())
+
+        :param filename:
+        :return: success or not
+        """
+        try:
+            incidents = iter_xml(filename)
+            self.clear()
+            for incident in incidents:
+                self[incident.report_id] = incident
+            return True
+        except (EnvironmentError, ValueError, KeyError, TypeError, AttributeError,
+                xml.etree.ElementTree.ParseError) as err:
+            print("{0}: import error: {1}".format(os.path.basename(sys.argv[0]), err))
+            return False
+
+
+# the file extension used for each format
+FORMAT_EXTENSIONS = {"binary": ".aib", "pickle": ".aip", "text": ".ait", "xml": ".aix", "log": ".ail"}
+# the IncidentCollection methods that read and write each format
+IMPORTERS = {".aib": "import_binary", ".aip": "import_pickle", ".ait": "import_text_stream",
+             ".aix": "import_xml_iterparse", ".ail": "import_log"}
+EXPORTERS = {"binary": "export_binary", "pickle": "export_pickle", "text": "export_text",
+             "xml": "export_xml_stream", "log": "export_log"}
+COMPRESSIBLE = {"binary", "pickle"}  # the exporters that take a compress argument
+
+
+def _conversion_report(source):
+    return {"source": source, "target": None, "records": 0, "source_size": None,
+            "target_size": None, "import_seconds": None, "export_seconds": None, "error": None}
+
+
+def _conversion_target(source, target_format, target_dir=None):
+    # the source's name with the target format's extension
+    name = os.path.splitext(os.path.basename(source))[0] + FORMAT_EXTENSIONS[target_format]
+    return os.path.join(target_dir if target_dir is not None else os.path.dirname(source), name)
+
+
+def convert_file(source, target_format, target_dir=None, compress=False):
+    """
+    convert one incidents file to another format
+
+    This is the unit of work for convert_batch() so it never raises: any
+    failure is recorded in the returned report instead.
+
+    :param source: the file to convert; its format is given by its extension
+    :param target_format: one of FORMAT_EXTENSIONS' keys
+    :param target_dir: where to write the result (default: beside the source)
+    :param compress: gzip the result if the target format supports it
+    :return: a dict with the source and target filenames, the number of
+             records, both file sizes, the import and export times in
+             seconds, and error (None if all went well)
+    """
+    report = _conversion_report(source)
+    try:
+        importer = IMPORTERS.get(os.path.splitext(source)[1].lower())
+        if importer is None:
+            raise ValueError("unrecognized incidents file extension")
+        if target_format not in EXPORTERS:
+            raise ValueError("unrecognized target format {0}".format(target_format))
+        target = _conversion_target(source, target_format, target_dir)
+        if os.path.abspath(target) == os.path.abspath(source):
+            raise ValueError("source and target are the same file")
+        report["target"] = target
+        report["source_size"] = os.path.getsize(source)
+
+        incidents = IncidentCollection()
+        start = time.time()
+        if not getattr(incidents, importer)(source):  # the importer has printed why
+            raise ValueError("import failed")
+        report["import_seconds"] = time.time() - start
+        report["records"] = len(incidents)
+
+        start = time.time()
+        exporter = getattr(incidents, EXPORTERS[target_format])
+        if not (exporter(target, compress) if target_format in COMPRESSIBLE else exporter(target)):
+            raise ValueError("export failed")
+        report["export_seconds"] = time.time() - start
+        report["target_size"] = os.path.getsize(target)
+    except Exception as err:  # one bad file must not stop the batch
+        report["error"] = "{0}: {1}".format(err.__class__.__name__, err)
+    return report
+
+
+def convert_batch(source, target_format, target_dir=None, compress=False, max_workers=None):
+    """
+    convert many incidents files in parallel using a pool of processes
+
+    :param source: a directory (every file in it with a recognized
+                   extension is converted) or a glob pattern
+    :param target_format: one of FORMAT_EXTENSIONS' keys
+    :param target_dir: where to write the results (default: beside each source)
+    :param compress: gzip the results if the target format supports it
+    :param max_workers: the number of processes (default: one per CPU)
+    :return: a list of convert_file() reports, in source filename order;
+             files that would be converted to the same target (e.g. m.aib
+             and m.aip), or to another of the files being read, are not
+             converted and their reports give the reason
+    """
+    if os.path.isdir(source):
+        filenames = [os.path.join(source, name) for name in os.listdir(source)
+                     if os.path.splitext(name)[1].lower() in IMPORTERS]
+    else:
+        filenames = glob.glob(source)
+    filenames.sort()
+    if target_dir is not None:
+        os.makedirs(target_dir, exist_ok=True)
+
+    reports = {}
+    if target_format in FORMAT_EXTENSIONS:  # otherwise convert_file() reports the error
+        # two processes must not write the same file at once, and one must
+        # not write over a file that another is reading
+        def path(filename):
+            return os.path.normcase(os.path.abspath(filename))
+
+        sources = {path(filename): filename for filename in filenames}
+        targets = collections.defaultdict(list)  # key: target path, value: the sources converted to it
+        for filename in filenames:
+            targets[path(_conversion_target(filename, target_format, target_dir))].append(filename)
+        for target, writers in targets.items():
+            clashing = writers[:]
+            if target in sources and sources[target] not in writers:
+                clashing.append(sources[target])
+            if len(clashing) > 1:
+                for filename in writers:
+                    report = reports[filename] = _conversion_report(filename)
+                    report["target"] = _conversion_target(filename, target_format, target_dir)
+                    report["error"] = "ValueError: the target {0} clashes with {1}".format(
+                        report["target"], ", ".join(other for other in clashing if other != filename))
+    with concurrent.futures.ProcessPoolExecutor(max_workers) as executor:
+        futures = {executor.submit(convert_file, filename, target_format, target_dir, compress): filename
+                   for filename in filenames if filename not in reports}
+        for future in concurrent.futures.as_completed(futures):
+            filename = futures[future]
+            try:
+                reports[filename] = future.result()
+            except Exception as err:  # e.g. the worker process died
+                reports[filename] = _conversion_report(filename)
+                reports[filename]["error"] = "{0}: {1}".format(err.__class__.__name__, err)
+    return [reports[filename] for filename in filenames]
+
+
+def detect_format(filename):
+    """
+    work out an incidents file's format from its first bytes, or failing
+    that from its extension
+
+    :param filename:
+    :return: (format, compressed) where format is one of FORMAT_EXTENSIONS'
+             keys and compressed is True if the file is gzipped
+    """
+    fh = open_binary(filename)
+    try:
+        compressed = isinstance(fh, gzip.GzipFile)
+        start = fh.read(64)
+    finally:
+        fh.close()
+    if start.startswith(MAGIC):
+        return "binary", compressed
+    if start.startswith(LOG_MAGIC):
+        return "log", compressed
+    if start.startswith(b"\x80"):  # the PROTO opcode that begins protocol 2+ pickles
+        return "pickle", compressed
+    start = start.lstrip()
+    if start.startswith(b"<?xml") or start.startswith(b"<incidents"):
+        return "xml", compressed
+    if start.startswith(b"["):
+        return "text", compressed
+    extension = os.path.splitext(filename)[1].lower()
+    for format, format_extension in FORMAT_EXTENSIONS.items():
+        if extension == format_extension:
+            return format, compressed
+    raise ValueError("cannot tell the format of {0}".format(filename))
+
+
+def iter_incidents(filename, format=None):
+    """
+    read an incidents file of any format one incident at a time
+
+    Every format except pickle and log is streamed; a pickle has to be
+    loaded whole, and a log replayed to the end.
+
+    :param filename:
+    :param format: one of FORMAT_EXTENSIONS' keys (default: detect_format())
+    :return: a generator of Incidents
+    """
+    if format is None:
+        format = detect_format(filename)[0]
+    if format == "binary":
+        return iter_binary(filename)
+    if format == "text":
+        return iter_text(filename)
+    if format == "xml":
+        return iter_xml(filename)
+    if format == "log":
+        return iter(replay_log(filename).values())
+    if format == "pickle":
+        fh = open_binary(filename)
+        try:
+            return iter(load_pickle(fh).values())
+        finally:
+            fh.close()
+    raise ValueError("unrecognized format {0}".format(format))
+
+
+def open_writer(filename, format, compress=False):
+    """
+    create the incremental writer for the given format
+
+    :param filename:
+    :param format: one of FORMAT_EXTENSIONS' keys
+    :param compress: gzip the file if the format supports it
+    :return: a writer with write(incident) and close() methods
+    """
+    if format == "binary":
+        return BinaryIncidentWriter(filename, compress)
+    if format == "pickle":
+        return PickleIncidentWriter(filename, compress)
+    if format == "text":
+        return TextIncidentWriter(filename)
+    if format == "xml":
+        return XmlIncidentWriter(filename)
+    if format == "log":
+        return IncidentLog(filename, new=True)
+    raise ValueError("unrecognized format {0}".format(format))
+
+
+def fan_out(incidents, writers, batch_size=FAN_OUT_BATCH_SIZE, queue_size=FAN_OUT_QUEUE_SIZE, threaded=None):
+    """
+    write the same incidents with several writers at once
+
+    incidents is iterated only once. Each writer runs in a thread of its
+    own, fed batches of incidents through a bounded queue, so one format's
+    encoding overlaps another's writing and gzip compression (zlib
+    releases the GIL), while memory use stays flat. Every writer is closed,
+    in its thread, whether or not it fails.
+
+    With a single CPU there is nothing to overlap and the threads only
+    contend for the GIL, so by default the writers are then called in turn
+    from this thread instead (still in one pass).
+
+    :param incidents: an iterable of Incidents
+    :param writers: writers with write() and close() methods, e.g. from
+                    open_writer()
+    :param batch_size:
+    :param queue_size:
+    :param threaded: whether to use writer threads (default: if there is
+                     more than one CPU)
+    :return: the number of incidents written
+    :raises: the first exception raised by a writer, once all are closed
+    """
+    if threaded is None:
+        threaded = (os.cpu_count() or 1) > 1
+    if not threaded:
+        return _fan_out_inline(incidents, writers, batch_size)
+    queues = [queue.Queue(queue_size) for _ in writers]
+    errors = [None] * len(writers)
+
+    def run(writer, batches, number):
+        try:
+            while True:
+                batch = batches.get()
+                if batch is None:
+                    break
+                for incident in batch:
+                    writer.write(incident)
+        except Exception as err:
+            errors[number] = err
+            while batches.get() is not None:  # so that the feeder never blocks on us
+                pass
+        finally:
+            try:
+                writer.close()
+            except Exception as err:
+                if errors[number] is None:
+                    errors[number] = err
+
+    threads = [threading.Thread(target=run, args=(writer, batches, number), daemon=True)
+               for number, (writer, batches) in enumerate(zip(writers, queues))]
+    for thread in threads:
+        thread.start()
+    count = 0
+    try:
+        batch = []
+        for incident in incidents:
+            batch.append(incident)
+            if len(batch) == batch_size:
+                for batches in queues:
+                    batches.put(batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            for batches in queues:
+                batches.put(batch)
+            count += len(batch)
+    finally:
+        for batches in queues:
+            batches.put(None)
+        for thread in threads:
+            thread.join()
+    for error in errors:
+        if error is not None:
+            raise error
+    return count
+
+
+def _fan_out_inline(incidents, writers, batch_size):
+    # each writer takes a whole batch in turn, which keeps its code and
+    # buffers hot, rather than every writer taking each incident in turn
+    count = 0
+    try:
+        batch = []
+        for incident in itertools.chain(incidents, (None,)):
+            if incident is not None:
+                batch.append(incident)
+                if len(batch) < batch_size:
+                    continue
+            for writer in writers:
+                for item in batch:
+                    writer.write(item)
+            count += len(batch)
+            batch = []
+    finally:
+        error = None
+        for writer in writers:
+            try:
+                writer.close()
+            except Exception as err:
+                if error is None:
+                    error = err
+    if error is not None:
+        raise error
+    return count
+
+
+def convert(source, target, target_format=None, compress=False):
+    """
+    convert an incidents file from one format to another
+
+    The source format is detected from the file; incidents are streamed
+    from the source's reader to the target's writer without building an
+    IncidentCollection (except for pickles, which must be whole).
+
+    :param source:
+    :param target:
+    :param target_format: one of FORMAT_EXTENSIONS' keys (default: from
+                          the target's extension)
+    :param compress: gzip the target if the format supports it
+    :return: a dict of the source and target formats, the number of
+             records, both file sizes and the seconds taken
+    """
+    if _same_file(source, target):  # the writer would truncate what is being read
+        raise ValueError("source and target are the same file")
+    source_format = detect_format(source)[0]
+    if target_format is None:
+        extension = os.path.splitext(target)[1].lower()
+        for format, format_extension in FORMAT_EXTENSIONS.items():
+            if extension == format_extension:
+                target_format = format
+                break
+        else:
+            raise ValueError("cannot tell the format for {0}".format(target))
+    start = time.perf_counter()
+    incidents = iter_incidents(source, source_format)
+    writer = open_writer(target, target_format, compress)
+    try:
+        for incident in incidents:
+            writer.write(incident)
+    finally:
+        writer.close()
+    return {"source_format": source_format, "target_format": target_format, "records": writer.count,
+            "source_size": os.path.getsize(source), "target_size": os.path.getsize(target),
+            "seconds": time.perf_counter() - start}
+
+
+def throughput(report):
+    """a one-line summary of a convert() report's speed"""
+    seconds = max(report["seconds"], 1e-9)
+    return ("{records:,} records {source_format} -> {target_format} in {seconds:.3f} sec: "
+            "{rate:,.0f} records/sec, {mb:.1f} MB/s read, {out:.1f} MB/s written".format(
+        rate=report["records"] / seconds, mb=report["source_size"] / seconds / 1e6,
+        out=report["target_size"] / seconds / 1e6, **report))
+
+
+def main():
+    parser = optparse.OptionParser(usage="usage: %prog [options] source target\n"
+                                         "       %prog [options] --batch source-dir-or-glob target-dir")
+    parser.add_option("-f", "--format", dest="format", choices=sorted(FORMAT_EXTENSIONS),
+                      help="the target format [default: from the target's extension]")
+    parser.add_option("-z", "--compress", dest="compress", action="store_true",
+                      help="gzip the target if its format supports it")
+    parser.add_option("-b", "--batch", dest="batch", action="store_true",
+                      help="convert many files in parallel; needs --format")
+    parser.add_option("-w", "--workers", dest="workers", type="int",
+                      help="the number of processes for --batch [default: one per CPU]")
+    parser.set_defaults(compress=False, batch=False)
+    opts, args = parser.parse_args()
+    if len(args) != 2:
+        parser.error("a source and a target are required")
+    source, target = args
+
+    if opts.batch:
+        if opts.format is None:
+            parser.error("--batch needs --format")
+        failures = 0
+        for report in convert_batch(source, opts.format, target, opts.compress, opts.workers):
+            if report["error"] is not None:
+                failures += 1
+                print("{0}: {1}".format(report["source"], report["error"]))
+            else:
+                print("{0} -> {1}: {2:,} records".format(report["source"], report["target"],
+                                                         report["records"]))
+        return 1 if failures else 0
+
+    try:
+        report = convert(source, target, opts.format, opts.compress)
+    except (EnvironmentError, ValueError, KeyError, IncidentError, pickle.UnpicklingError,
+            xml.etree.ElementTree.ParseError) as err:
+        print("{0}: conversion error: {1}".format(os.path.basename(sys.argv[0]), err))
+        return 1
+    print(throughput(report))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,188 @@
+"""
+group-by/count/sum/mean statistics over incidents, computed a column at a time
+
+The functions work on the columns of an IncidentTable (see
+convert-incidents.py), so no Incident objects are created. NumPy is used
+when it is installed; otherwise the same results are computed with the
+array module and builtins such as map() and collections.Counter.
+
+Anything else that holds incidents, such as an IncidentCollection, is
+turned into columns first with one pass over its incidents; to aggregate
+the same incidents repeatedly, put them in an IncidentTable once instead.
+
+table = IncidentTable(incidents.values())
+mean_hours_on_type(table) -> 1234.5
+midair_rate_by_airport(table) -> {"LHR": 0.05, ...}
+incidents_per_month(table) -> {(2007, 1): 31, (2007, 2): 28, ...}
+"""
+
+import array
+import collections
+import datetime
+import itertools
+import operator
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# date ordinal of numpy's datetime64 epoch, 1970-01-01
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+
+Columns = collections.namedtuple("Columns", "count dates pilot_percent_hours_on_type pilot_total_hours "
+                                            "midair_bitmap airports airport_ids aircraft_types aircraft_type_ids")
+Columns.__doc__ = """
+the columns the aggregates are computed from, laid out as in IncidentTable
+
+airports and aircraft_types are sequences of distinct strings which
+airport_ids and aircraft_type_ids refer to by position.
+"""
+
+
+def columns(incidents):
+    """
+    the Columns of an IncidentTable, or of any other iterable of incidents
+
+    :param incidents: an IncidentTable, an IncidentCollection (its values
+                      are used) or an iterable of Incidents
+    :return: Columns
+    """
+    if hasattr(incidents, "midair_bitmap"):
+        return Columns(len(incidents), incidents.dates, incidents.pilot_percent_hours_on_type,
+                       incidents.pilot_total_hours, incidents.midair_bitmap,
+                       list(incidents.airports), incidents.airport_ids,
+                       list(incidents.aircraft_types), incidents.aircraft_type_ids)
+    if isinstance(incidents, dict):
+        incidents = incidents.values()
+    dates = array.array("I")
+    percents = array.array("d")
+    totals = array.array("i")
+    midair_bitmap = bytearray()
+    airports = {}
+    airport_ids = array.array("I")
+    aircraft_types = {}
+    aircraft_type_ids = array.array("I")
+    count = 0
+    for count, incident in enumerate(incidents, start=1):
+        dates.append(incident.date.toordinal())
+        percents.append(incident.pilot_percent_hours_on_type)
+        totals.append(incident.pilot_total_hours)
+        row = count - 1
+        if row % 8 == 0:
+            midair_bitmap.append(0)
+        if incident.midair:
+            midair_bitmap[row >> 3] |= 1 << (row & 7)
+        airport_ids.append(airports.setdefault(incident.airport, len(airports)))
+        aircraft_type_ids.append(aircraft_types.setdefault(incident.aircraft_type, len(aircraft_types)))
+    return Columns(count, dates, percents, totals, midair_bitmap, list(airports),
+                   airport_ids, list(aircraft_types), aircraft_type_ids)
+
+
+def _as_numpy(column, dtype=None):
+    # arrays and bytearrays support the buffer protocol, so this doesn't copy
+    return numpy.frombuffer(column, dtype=dtype if dtype is not None else column.typecode)
+
+
+def midair_rows(cols):
+    """the row numbers of the midair incidents, in order"""
+    if numpy is not None:
+        bits = numpy.unpackbits(_as_numpy(cols.midair_bitmap, numpy.uint8), bitorder="little")
+        return numpy.flatnonzero(bits[:cols.count]).tolist()
+    rows = []
+    for index, byte in enumerate(cols.midair_bitmap):
+        if byte:  # most bytes are zero, so this skips most rows eight at a time
+            rows.extend(index * 8 + bit for bit in range(8) if byte & (1 << bit))
+    return rows
+
+
+def hours_on_type(cols):
+    """each row's Incident.approximate_hours_on_type, as an array"""
+    if numpy is not None:
+        hours = _as_numpy(cols.pilot_total_hours) * _as_numpy(cols.pilot_percent_hours_on_type) / 100
+        return array.array("q", hours.astype(numpy.int64).tobytes())
+    return array.array("q", map(int, map(operator.truediv,
+                                         map(operator.mul, cols.pilot_total_hours,
+                                             cols.pilot_percent_hours_on_type),
+                                         itertools.repeat(100))))
+
+
+def group_count(keys, groups):
+    """
+    the number of rows in each group
+
+    :param keys: each row's group number, 0 <= key < groups
+    :param groups: the number of groups
+    :return: a list of groups counts
+    """
+    if numpy is not None:
+        return numpy.bincount(_as_numpy(keys), minlength=groups).tolist()
+    counts = collections.Counter(keys)
+    return [counts[group] for group in range(groups)]
+
+
+def group_sum(keys, values, groups):
+    """
+    the sum of the values in each group
+
+    :param keys: each row's group number, 0 <= key < groups
+    :param values: each row's value
+    :param groups: the number of groups
+    :return: a list of groups sums
+    """
+    if numpy is not None:
+        return numpy.bincount(_as_numpy(keys), weights=_as_numpy(values), minlength=groups).tolist()
+    sums = [0] * groups
+    for key, value in zip(keys, values):
+        sums[key] += value
+    return sums
+
+
+def group_mean(keys, values, groups):
+    """the mean of the values in each group, or None for an empty group"""
+    return [None if count == 0 else total / count
+            for total, count in zip(group_sum(keys, values, groups), group_count(keys, groups))]
+
+
+def mean_hours_on_type(incidents):
+    """the mean approximate_hours_on_type, or None if there are no incidents"""
+    cols = columns(incidents)
+    if cols.count == 0:
+        return None
+    return sum(hours_on_type(cols)) / cols.count
+
+
+def mean_hours_on_type_by_aircraft_type(incidents):
+    """a dict of aircraft type -> mean approximate_hours_on_type"""
+    cols = columns(incidents)
+    means = group_mean(cols.aircraft_type_ids, hours_on_type(cols), len(cols.aircraft_types))
+    return {aircraft_type: mean for aircraft_type, mean in zip(cols.aircraft_types, means)
+            if mean is not None}
+
+
+def midair_rate_by_airport(incidents):
+    """a dict of airport -> the fraction of its incidents that were midair"""
+    cols = columns(incidents)
+    groups = len(cols.airports)
+    counts = group_count(cols.airport_ids, groups)
+    airport_ids = cols.airport_ids
+    midairs = group_count(array.array("I", [airport_ids[row] for row in midair_rows(cols)]), groups)
+    return {airport: midair / count for airport, midair, count in zip(cols.airports, midairs, counts)
+            if count}
+
+
+def incidents_per_month(incidents):
+    """a dict of (year, month) -> the number of incidents, in date order"""
+    cols = columns(incidents)
+    if numpy is not None:
+        days = (_as_numpy(cols.dates).astype(numpy.int64) - EPOCH_ORDINAL).astype("datetime64[D]")
+        months, counts = numpy.unique(days.astype("datetime64[M]"), return_counts=True)
+        return {(month.year, month.month): count
+                for month, count in zip(months.astype(datetime.date).tolist(), counts.tolist())}
+    # there are far fewer distinct days than incidents, so only they are converted to dates
+    per_month = collections.Counter()
+    for ordinal, count in collections.Counter(cols.dates).items():
+        date = datetime.date.fromordinal(ordinal)
+        per_month[date.year, date.month] += count
+    return dict(sorted(per_month.items()))